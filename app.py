@@ -1,51 +1,414 @@
 import gradio as gr
 from urllib.parse import urlparse
-import requests
-import time
+import asyncio
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utils.gradio_helpers import parse_outputs, process_outputs
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+from utils import cog_client
+from utils.gradio_helpers import build_payload, iter_outputs, outputs_available, process_outputs, request_prediction, request_prediction_async, run_blocking
+from utils.admission import ADMISSION_MAX_QUEUE, BULK, INTERACTIVE, SUBMIT, get_admission_controller
+from utils.metrics import NullTrace, registry, start_trace
+from utils.output_store import get_output_store
+from utils.output_sink import add_output_sink_routes
+from utils.rest_api import make_render_endpoint
+from utils.input_normalize import normalized_input
+from utils.backends import get_backend_pool
+from utils.result_cache import ResultCache, hash_file, make_cache_key
+from utils.scheduler import LatestWinsScheduler
+from utils.singleflight import SingleFlight
+from utils.prefetch import PREFETCH_ENABLED, PREFETCH_HEADROOM, Prefetcher
+from utils.startup import startup_state
+from utils.animation import ANIMATION_MAX_FRAMES, KeyframeError, create_encoder, interpolate_frames, parse_keyframes, render_animation
+from utils.sweep import SWEEP_MAX_RENDERS, make_contact_sheet, sweep_grid, sweep_values
 
 names = ['image', 'rotate_pitch', 'rotate_yaw', 'rotate_roll', 'blink', 'eyebrow', 'wink', 'pupil_x', 'pupil_y', 'aaa', 'eee', 'woo', 'smile', 'src_ratio', 'sample_ratio', 'crop_factor', 'output_format', 'output_quality']
+sweep_names = names[1:16]
 
-def predict(request: gr.Request, *args, progress=gr.Progress(track_tqdm=True)):
-    headers = {'Content-Type': 'application/json'}
+# Slider edits show a quick low-quality encoding before the final render
+PREVIEW_ENABLED = os.environ.get("PREVIEW_ENABLED", "1") == "1"
+PREVIEW_FORMAT = os.environ.get("PREVIEW_FORMAT", "jpg")
+PREVIEW_QUALITY = int(os.environ.get("PREVIEW_QUALITY", 40))
 
-    payload = {"input": {}}
-    
-    
-    base_url = "http://0.0.0.0:7860"
-    for i, key in enumerate(names):
-        value = args[i]
-        if value and (os.path.exists(str(value))):
-            value = f"{base_url}/file=" + value
-        if value is not None and value != "":
-            payload["input"][key] = value
+result_cache = ResultCache()
+scheduler = LatestWinsScheduler()
+coalescer = SingleFlight()
+registry.register_gauges("result_cache", result_cache.stats)
+registry.register_gauges("output_store", lambda: get_output_store().stats())
+registry.register_gauges("backends", lambda: get_backend_pool().stats())
+registry.register_gauges("admission", lambda: get_admission_controller().stats())
+registry.register_gauges("coalescer", coalescer.stats)
+registry.register_gauges("scheduler", lambda: {"superseded": scheduler.superseded, "cancelled": scheduler.cancelled})
+
+def lookup_cached(cache_key):
+    output = result_cache.get(cache_key)
+    # Files Cog uploaded to the sink may have been evicted since
+    if output is not None and not outputs_available(output):
+        return None
+    return output
+
+def is_idle():
+    stats = get_admission_controller().stats()
+    return not stats["queued"] and stats["inflight"] + PREFETCH_HEADROOM < stats["capacity"]
+
+def prefetch_output(args, prediction_id, on_backend):
+    trace = start_trace("prefetch")
+    status = "error"
+    try:
+        cache_key = make_cache_key(names, args)
+        if result_cache.contains(cache_key):
+            status = "cached"
+            return
+        # Prefetches never queue or retry, and when one is preempted any real
+        # request coalesced onto it runs the prediction itself
+        give_way = lambda: True
+        output = coalescer.do(cache_key, lambda: fetch_output(
+            args,
+            trace,
+            prediction_id,
+            abandoned=give_way,
+            on_backend=on_backend,
+            session="prefetch",
+            priority=BULK,
+        ), give_way)
+        result_cache.put(cache_key, output)
+        status = "ok"
+    finally:
+        trace.finish(status)
 
-    response = requests.post("http://0.0.0.0:5000/predictions", headers=headers, json=payload)
+prefetcher = Prefetcher(prefetch_output, is_idle) if PREFETCH_ENABLED else None
+if prefetcher is not None:
+    registry.register_gauges("prefetch", prefetcher.stats)
 
+def build_result(output, trace=None):
+    #If the output component is JSON return the entire output response 
+    if(outputs[0].get_config()["name"] == "json"):
+        return output
+    with (trace or NullTrace()).stage("decode"):
+        predict_outputs = iter_outputs(output)
+        # Serve the encoded bytes as-is so output_format/output_quality survive
+        processed_outputs = process_outputs(predict_outputs, passthrough=True)
     
-    if response.status_code == 201:
-        follow_up_url = response.json()["urls"]["get"]
-        response = requests.get(follow_up_url, headers=headers)
-        while response.json()["status"] != "succeeded":
-            if response.json()["status"] == "failed":
-                raise gr.Error("The submission failed!")
-            response = requests.get(follow_up_url, headers=headers)
-            time.sleep(1)
-    if response.status_code == 200:
-        json_response = response.json()
-        #If the output component is JSON return the entire output response 
-        if(outputs[0].get_config()["name"] == "json"):
-            return json_response["output"]
-        predict_outputs = parse_outputs(json_response["output"])
-        processed_outputs = process_outputs(predict_outputs)
-        
-        return tuple(processed_outputs) if len(processed_outputs) > 1 else processed_outputs[0]
-    else:
-        if(response.status_code == 409):
-            raise gr.Error(f"Sorry, the Cog image is still processing. Try again in a bit.")
-        raise gr.Error(f"The submission failed! Error: {response.status_code}")
+    return tuple(processed_outputs) if len(processed_outputs) > 1 else processed_outputs[0]
+
+def wait_until_ready(trace, progress):
+    if not startup_state.is_ready():
+        progress(0, desc=startup_state.describe())
+        with trace.stage("startup_wait"):
+            if not startup_state.wait_ready():
+                raise gr.Error(startup_state.describe() or "The model is not ready yet. Try again in a bit.")
+
+async def wait_until_ready_async(trace, progress):
+    if not startup_state.is_ready():
+        progress(0, desc=startup_state.describe())
+        with trace.stage("startup_wait"):
+            if not await startup_state.wait_ready_async():
+                raise gr.Error(startup_state.describe() or "The model is not ready yet. Try again in a bit.")
+
+def prepare_request(args, prediction_id=None):
+    payload = build_payload(names, args, base_url="http://0.0.0.0:7860")
+    payload["id"] = prediction_id or uuid.uuid4().hex
+    image_path = args[names.index("image")]
+    affinity = hash_file(image_path) if image_path and os.path.exists(str(image_path)) else None
+    return payload, affinity
+
+def fetch_output(args, trace, prediction_id=None, **request_kwargs):
+    headers = {'Content-Type': 'application/json'}
+
+    with trace.stage("payload"):
+        payload, affinity = prepare_request(args, prediction_id)
+
+    json_response = request_prediction(
+        get_backend_pool(),
+        payload,
+        headers,
+        trace,
+        affinity=affinity,
+        **request_kwargs,
+    )
+    return json_response["output"]
+
+async def fetch_output_async(args, trace, prediction_id=None, **request_kwargs):
+    headers = {'Content-Type': 'application/json'}
+
+    with trace.stage("payload"):
+        # Reading and encoding the upload is file and CPU work
+        payload, affinity = await run_blocking(prepare_request, args, prediction_id)
+
+    json_response = await request_prediction_async(
+        get_backend_pool(),
+        payload,
+        headers,
+        trace,
+        affinity=affinity,
+        **request_kwargs,
+    )
+    return json_response["output"]
+
+_background_tasks = set()
+
+def spawn(coroutine):
+    # Keep a reference so the task isn't collected before it finishes
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def begin_ticket(request):
+    # API clients without a session never supersede each other
+    return scheduler.begin(session_of(request) or uuid.uuid4().hex)
+
+def session_of(request):
+    return getattr(request, "session_hash", None)
+
+async def render(request, args, debounce, progress, ticket=None, trace_path="app", priority=SUBMIT, cancels=None):
+    # A ticket passed in stays open for the caller's next render; cancels
+    # collects this render's own Cog cancel callback
+    trace = start_trace(trace_path)
+    status = "error"
+    owns_ticket = ticket is None
+    if owns_ticket:
+        ticket = begin_ticket(request)
+    try:
+        await wait_until_ready_async(trace, progress)
+        with trace.stage("cache_lookup"):
+            cache_key = await run_blocking(make_cache_key, names, args)
+            cached_output = await run_blocking(lookup_cached, cache_key)
+        if cached_output is not None:
+            status = "cached"
+            return await run_blocking(build_result, cached_output, trace)
+        # A newer edit arrived while this one was waiting, drop it
+        status = "superseded"
+        if not await scheduler.wait_async(ticket, debounce):
+            return gr.update()
+
+        if prefetcher is not None and not is_idle():
+            await run_blocking(prefetcher.preempt, list(args))
+        # Cancel on whichever backend the pool routes the prediction to; the
+        # scheduler may call this from any thread, so hop onto the loop
+        loop = asyncio.get_running_loop()
+        prediction_id = uuid.uuid4().hex
+        backend_urls = []
+        cancel = lambda: [loop.call_soon_threadsafe(spawn, cog_client.cancel_prediction_async(f"{url}/predictions", prediction_id)) for url in backend_urls]
+        scheduler.attach(ticket, cancel)
+        if cancels is not None:
+            cancels.append(cancel)
+        abandoned = lambda: not scheduler.is_current(ticket)
+        try:
+            # Identical renders already in flight are shared, not repeated
+            output = await coalescer.do_async(cache_key, lambda: fetch_output_async(
+                args,
+                trace,
+                prediction_id,
+                on_position=lambda position: progress(0, desc=f"Waiting for the GPU, position {position} in queue"),
+                abandoned=abandoned,
+                on_backend=backend_urls.append,
+                session=session_of(request),
+                priority=priority,
+            ), abandoned)
+        except gr.Error:
+            if not scheduler.is_current(ticket):
+                return gr.update()
+            status = "error"
+            raise
+        await run_blocking(result_cache.put, cache_key, output)
+        if not scheduler.is_current(ticket):
+            return gr.update()
+        status = "ok"
+        return await run_blocking(build_result, output, trace)
+    finally:
+        if owns_ticket:
+            scheduler.finish(ticket)
+        trace.finish(status)
+
+def render_cached(args, trace_path, session=None):
+    # Sweeps and animations queue behind the session's interactive edits
+    trace = start_trace(trace_path)
+    status = "error"
+    try:
+        cache_key = make_cache_key(names, args)
+        output = lookup_cached(cache_key)
+        if output is None:
+            output = coalescer.do(cache_key, lambda: fetch_output(args, trace, session=session, priority=BULK))
+            result_cache.put(cache_key, output)
+            status = "ok"
+        else:
+            status = "cached"
+        return build_result(output, trace)
+    finally:
+        trace.finish(status)
+
+async def render_file(args, session=None, priority=SUBMIT):
+    # The REST endpoint's render: same cache and Cog path, no Gradio session
+    trace = start_trace("rest")
+    status = "error"
+    try:
+        await wait_until_ready_async(trace, lambda *args, **kwargs: None)
+        cache_key = await run_blocking(make_cache_key, names, args)
+        output = await run_blocking(lookup_cached, cache_key)
+        if output is None:
+            output = await coalescer.do_async(cache_key, lambda: fetch_output_async(args, trace, session=session, priority=priority))
+            await run_blocking(result_cache.put, cache_key, output)
+            status = "ok"
+        else:
+            status = "cached"
+        return await run_blocking(build_result, output, trace)
+    finally:
+        trace.finish(status)
+
+def sweep(request: gr.Request, *args, progress=gr.Progress()):
+    base_args = list(args[:len(names)])
+    param_x, min_x, max_x, steps_x, param_y, min_y, max_y, steps_y = args[len(names):]
+    if not base_args[names.index("image")]:
+        raise gr.Error("Upload an input image first.")
+    axes = [(param_x, sweep_values(min_x, max_x, steps_x))]
+    if param_y and param_y != "None" and param_y != param_x:
+        axes.append((param_y, sweep_values(min_y, max_y, steps_y)))
+    total = len(axes[0][1]) * (len(axes[1][1]) if len(axes) > 1 else 1)
+    if total > SWEEP_MAX_RENDERS:
+        raise gr.Error(f"A sweep can render at most {SWEEP_MAX_RENDERS} images, this one needs {total}.")
+    wait_until_ready(NullTrace(), progress)
+
+    cells = {}
+    failures = 0
+    # Fill every Cog thread; admission control keeps other users in line
+    with ThreadPoolExecutor(max_workers=get_admission_controller().capacity) as executor:
+        futures = {}
+        for row, column, values in sweep_grid(axes):
+            cell_args = list(base_args)
+            for key, value in values.items():
+                cell_args[names.index(key)] = value
+            label = ", ".join(f"{key}={value:g}" for key, value in values.items())
+            futures[executor.submit(render_cached, cell_args, "sweep", session_of(request))] = (row, column, label)
+        for done, future in enumerate(as_completed(futures), 1):
+            row, column, label = futures[future]
+            progress(done / total, desc=f"Rendered {done}/{total}")
+            try:
+                cells[(row, column)] = (future.result(), label)
+            except gr.Error:
+                failures += 1
+                continue
+            yield [cells[key] for key in sorted(cells)], gr.update()
+    if not cells:
+        raise gr.Error("The sweep failed, no image could be rendered.")
+    if failures:
+        gr.Warning(f"{failures} of {total} sweep renders failed.")
+    rows = len(axes[1][1]) if len(axes) > 1 else 1
+    yield [cells[key] for key in sorted(cells)], make_contact_sheet(cells, rows, len(axes[0][1]))
+
+def animate(request: gr.Request, *args, progress=gr.Progress()):
+    base_args = list(args[:len(names)])
+    keyframes_text, frame_count, fps, animation_format = args[len(names):]
+    if not base_args[names.index("image")]:
+        raise gr.Error("Upload an input image first.")
+    frame_count = int(frame_count)
+    if frame_count > ANIMATION_MAX_FRAMES:
+        raise gr.Error(f"An animation can have at most {ANIMATION_MAX_FRAMES} frames.")
+    try:
+        keyframes = parse_keyframes(keyframes_text, frame_count, sweep_names)
+    except KeyframeError as e:
+        raise gr.Error(str(e))
+    wait_until_ready(NullTrace(), progress)
+
+    base_values = {key: base_args[names.index(key)] for key in sweep_names}
+    frames = []
+    for values in interpolate_frames(keyframes, frame_count, base_values):
+        frame_args = list(base_args)
+        for key, value in values.items():
+            frame_args[names.index(key)] = value
+        frames.append(frame_args)
+
+    filename = render_animation(
+        frames,
+        lambda frame_args: render_cached(frame_args, "animation", session_of(request)),
+        create_encoder(fps, animation_format),
+        # Twice the thread count keeps Cog busy while the encoder catches up
+        window=get_admission_controller().capacity * 2,
+        on_frame=lambda done, total: progress(done / total, desc=f"Encoded frame {done}/{total}"),
+    )
+    if filename.endswith(".mp4"):
+        return gr.update(value=filename, visible=True), gr.update(visible=False)
+    return gr.update(visible=False), gr.update(value=filename, visible=True)
+
+def sweep_range(name):
+    component = dict(zip(names, inputs)).get(name)
+    if component is None:
+        return gr.update(), gr.update()
+    minimum = getattr(component, "minimum", None)
+    maximum = getattr(component, "maximum", None)
+    return (
+        gr.update(value=component.value if minimum is None else minimum),
+        gr.update(value=component.value if maximum is None else maximum),
+    )
+
+async def predict(request: gr.Request, *args, progress=gr.Progress(track_tqdm=True)):
+    return await render(request, args, debounce=0, progress=progress)
+
+def prepare_upload(image_path):
+    # Normalize right after the upload so the first render doesn't wait for it
+    if image_path:
+        normalized_input(image_path)
+
+def slider_bounds():
+    return {
+        key: (component.minimum, component.maximum)
+        for key, component in zip(names, inputs)
+        if key in sweep_names and isinstance(component, gr.Slider)
+    }
+
+def preview_args(args):
+    args = list(args)
+    args[names.index("output_format")] = PREVIEW_FORMAT
+    args[names.index("output_quality")] = PREVIEW_QUALITY
+    return args
+
+def preview_fits():
+    # A preview is a full inference with a cheaper encode, so it is only
+    # worth running on slots nobody else is waiting for
+    controller = get_admission_controller()
+    stats = controller.stats()
+    return controller.session_inflight >= 2 and not stats["queued"] and stats["inflight"] + 2 <= stats["capacity"]
+
+async def predict_interactive(request: gr.Request, *args, progress=gr.Progress(track_tqdm=True)):
+    ticket = begin_ticket(request)
+    try:
+        final_key = await run_blocking(make_cache_key, names, args)
+        if PREVIEW_ENABLED and not result_cache.contains(final_key) and preview_fits():
+            # Render a cheap encoding and the requested quality side by side;
+            # the preview shows first unless the final beats it
+            preview_cancels, final_cancels = [], []
+            preview = asyncio.ensure_future(render(request, preview_args(args), debounce=None, progress=progress, ticket=ticket, trace_path="preview", priority=INTERACTIVE, cancels=preview_cancels))
+            final = asyncio.ensure_future(render(request, args, debounce=None, progress=progress, ticket=ticket, priority=INTERACTIVE, cancels=final_cancels))
+            try:
+                await asyncio.wait([preview, final], return_when=asyncio.FIRST_COMPLETED)
+                preview_failed = preview.done() and preview.exception() is not None
+                if not final.done() and not preview_failed:
+                    yield preview.result()
+                    if not scheduler.is_current(ticket):
+                        return
+                # A failed preview is not worth an error, the final decides
+                yield await final
+            finally:
+                for task, task_cancels in ((preview, preview_cancels), (final, final_cancels)):
+                    if task.done():
+                        continue
+                    # The losing or abandoned prediction would otherwise keep
+                    # a Cog thread busy after its admission slot is freed
+                    for cancel in task_cancels:
+                        scheduler.detach(ticket, cancel)
+                        cancel()
+                    task.cancel()
+        else:
+            yield await render(request, args, debounce=None, progress=progress, ticket=ticket, priority=INTERACTIVE)
+    finally:
+        scheduler.finish(ticket)
+    session_id = session_of(request)
+    if prefetcher is not None and session_id:
+        # The next nudge of the same slider is likely one more step along
+        prefetcher.observe(session_id, args, names, slider_bounds())
 
 
 css = '''
@@ -55,6 +418,7 @@ with gr.Blocks() as demo:
     with gr.Column():
         gr.Markdown("# Expression Editor")
         gr.Markdown("Demo for expression-editor cog image by fofr")
+        status_banner = gr.Markdown()
         with gr.Row():
             with gr.Column():
                 image = gr.Image(
@@ -146,6 +510,60 @@ with gr.Blocks() as demo:
                     </p>
                 </div>
                 """)
+        with gr.Accordion("Parameter sweep", open=False):
+            with gr.Row():
+                with gr.Column():
+                    with gr.Row():
+                        sweep_param_x = gr.Dropdown(
+                            choices=sweep_names, label="Sweep parameter", value="smile"
+                        )
+                        sweep_min_x = gr.Number(label="From", value=-0.3)
+                        sweep_max_x = gr.Number(label="To", value=1.3)
+                        sweep_steps_x = gr.Slider(
+                            label="Steps", value=5,
+                            minimum=1, maximum=16, step=1
+                        )
+                    with gr.Row():
+                        sweep_param_y = gr.Dropdown(
+                            choices=["None"] + sweep_names, label="Second parameter", value="None"
+                        )
+                        sweep_min_y = gr.Number(label="From", value=-20)
+                        sweep_max_y = gr.Number(label="To", value=20)
+                        sweep_steps_y = gr.Slider(
+                            label="Steps", value=3,
+                            minimum=1, maximum=16, step=1
+                        )
+                    sweep_btn = gr.Button("Run sweep")
+                with gr.Column():
+                    sweep_gallery = gr.Gallery(label="Sweep results", columns=5)
+                    contact_sheet = gr.Image(label="Contact sheet", type="filepath")
+        with gr.Accordion("Animation", open=False):
+            with gr.Row():
+                with gr.Column():
+                    keyframes = gr.Code(
+                        label="Keyframes", language="json",
+                        value='''[
+  {"frame": 0},
+  {"frame": 24, "smile": 1.0, "rotate_yaw": 10},
+  {"frame": 47, "smile": 0, "blink": -10}
+]'''
+                    )
+                    with gr.Row():
+                        frame_count = gr.Slider(
+                            label="Frames", value=48,
+                            minimum=2, maximum=240, step=1
+                        )
+                        fps = gr.Slider(
+                            label="FPS", value=24,
+                            minimum=1, maximum=30, step=1
+                        )
+                        animation_format = gr.Dropdown(
+                            choices=['mp4', 'webp'], label="Animation format", value="mp4"
+                        )
+                    animate_btn = gr.Button("Render animation")
+                with gr.Column():
+                    animation_video = gr.Video(label="Animation")
+                    animation_image = gr.Image(label="Animation", type="filepath", visible=False)
 
     inputs = [image, rotate_pitch, rotate_yaw, rotate_roll, blink, eyebrow, wink, pupil_x, pupil_y, aaa, eee, woo, smile, src_ratio, sample_ratio, crop_factor, output_format, output_quality]
     outputs = [result_image]
@@ -156,17 +574,52 @@ with gr.Blocks() as demo:
         outputs=outputs,
     )
 
-    rotate_pitch.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    rotate_yaw.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    rotate_roll.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    blink.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    eyebrow.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    wink.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    pupil_x.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    pupil_y.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    aaa.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    eee.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    woo.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-    smile.release(fn=predict, inputs=inputs, outputs=outputs, show_progress="minimal")
-
-demo.launch(share=False, show_error=True)
\ No newline at end of file
+    rotate_pitch.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    rotate_yaw.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    rotate_roll.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    blink.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    eyebrow.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    wink.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    pupil_x.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    pupil_y.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    aaa.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    eee.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    woo.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+    smile.release(fn=predict_interactive, inputs=inputs, outputs=outputs, show_progress="minimal", trigger_mode="always_last")
+
+    image.upload(fn=prepare_upload, inputs=image, outputs=None, show_progress="hidden")
+
+    sweep_inputs = [sweep_param_x, sweep_min_x, sweep_max_x, sweep_steps_x, sweep_param_y, sweep_min_y, sweep_max_y, sweep_steps_y]
+    # Sweeps and animations still block a worker thread while they fan out
+    sweep_btn.click(fn=sweep, inputs=inputs + sweep_inputs, outputs=[sweep_gallery, contact_sheet], concurrency_limit=2, concurrency_id="bulk")
+    animate_btn.click(fn=animate, inputs=inputs + [keyframes, frame_count, fps, animation_format], outputs=[animation_video, animation_image], concurrency_limit=2, concurrency_id="bulk")
+    sweep_param_x.change(fn=sweep_range, inputs=sweep_param_x, outputs=[sweep_min_x, sweep_max_x], queue=False)
+    sweep_param_y.change(fn=sweep_range, inputs=sweep_param_y, outputs=[sweep_min_y, sweep_max_y], queue=False)
+
+    demo.load(fn=startup_state.describe, outputs=status_banner, queue=False)
+
+# Waiting renders are coroutines, so Gradio can hand over everything the
+# admission controller is able to queue and report positions for
+demo.queue(default_concurrency_limit=int(os.environ.get("GRADIO_CONCURRENCY", get_admission_controller().capacity + ADMISSION_MAX_QUEUE)))
+
+def metrics_endpoint():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+def launch():
+    # Serve Gradio under FastAPI so plain HTTP routes can sit next to it
+    app = FastAPI()
+    app.add_api_route("/metrics", metrics_endpoint, methods=["GET"])
+    add_output_sink_routes(app)
+    # Programmatic clients skip Gradio's queue and event protocol
+    app.add_api_route("/render", make_render_endpoint(names, [component.value for component in inputs], render_file), methods=["POST"])
+    app = gr.mount_gradio_app(app, demo, path="/")
+    uvicorn.run(
+        app,
+        host=os.environ.get("GRADIO_SERVER_NAME", "0.0.0.0"),
+        port=int(os.environ.get("GRADIO_SERVER_PORT", 7860)),
+        # Lets clients reuse one connection across a series of renders
+        timeout_keep_alive=int(os.environ.get("HTTP_KEEP_ALIVE", 75)),
+    )
+
+if __name__ == "__main__":
+    launch()
@@ -0,0 +1,226 @@
+"""Apply expression presets to a directory or manifest of portraits.
+
+    python batch.py --presets presets.json --input-dir portraits/ --output-dir out/
+    python batch.py --presets presets.json --manifest inputs.jsonl --output-dir out/ \
+        --endpoint http://gpu-1:5000 --endpoint http://gpu-2:5000
+
+presets.json maps a preset name to parameter values over app.names, e.g.
+{"smile": {"smile": 1.0}, "surprised": {"eyebrow": 10, "aaa": 60}}. A
+manifest has one input per line, either a path or a JSON object with an
+"image" path and an optional "id". Results are appended to results.jsonl in
+the output directory; running the same command again skips every
+(id, preset) that already finished.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff")
+RESULTS_MANIFEST = "results.jsonl"
+
+
+def iter_directory(input_dir):
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, filename)
+                item_id = os.path.splitext(os.path.relpath(path, input_dir))[0]
+                yield item_id.replace(os.sep, "/"), path
+
+
+def iter_manifest(manifest):
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                path = entry["image"]
+                item_id = entry.get("id")
+            else:
+                path, item_id = line, None
+            path = os.path.join(base_dir, path)
+            item_id = os.path.normpath(item_id or os.path.splitext(os.path.basename(path))[0])
+            if os.path.isabs(item_id) or item_id.startswith(".."):
+                raise SystemExit(f"Manifest id {item_id!r} would write outside --output-dir")
+            yield item_id, path
+
+
+def load_presets(path, names):
+    with open(path, "r") as f:
+        presets = json.load(f)
+    for preset, values in presets.items():
+        unknown = sorted(set(values) - set(names[1:]))
+        if unknown:
+            raise SystemExit(f"Preset {preset!r} sets unknown parameters: {unknown}")
+    return presets
+
+
+def load_finished(results_path):
+    # A record only counts when its output file survived as well
+    finished = set()
+    if not os.path.exists(results_path):
+        return finished
+    with open(results_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be torn if the previous run was killed
+                continue
+            if record.get("status") == "ok" and os.path.exists(record["output"]):
+                finished.add((record["id"], record["preset"]))
+    return finished
+
+
+class ResultsWriter:
+    def __init__(self, path):
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+        self.ok = 0
+        self.failed = 0
+
+    def write(self, record):
+        with self._lock:
+            if record["status"] == "ok":
+                self.ok += 1
+            else:
+                self.failed += 1
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--presets", required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input-dir")
+    source.add_argument("--manifest")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument(
+        "--endpoint",
+        action="append",
+        help="Cog base URL, repeat for several; defaults to COG_API_URLS",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="predictions in flight, defaults to the Cog threads of all endpoints",
+    )
+    parser.add_argument("--wait", type=float, default=300, help="seconds to wait for Cog")
+    args = parser.parse_args()
+
+    if args.endpoint:
+        # Read by utils.backends when it is first imported
+        os.environ["COG_API_URLS"] = ",".join(args.endpoint)
+
+    import gradio as gr
+
+    import app
+    from utils.admission import BULK
+    from utils.backends import ROUTABLE_STATUSES, get_backend_pool
+    from utils.gradio_helpers import (
+        build_payload,
+        parse_outputs,
+        process_outputs,
+        request_prediction,
+    )
+    from utils.output_store import get_output_store
+    from utils.result_cache import hash_file
+    from utils.startup import wait_for_health
+
+    names = app.names
+    defaults = [component.value for component in app.inputs]
+    presets = load_presets(args.presets, names)
+    backend_pool = get_backend_pool()
+    concurrency = args.concurrency or backend_pool.capacity
+
+    deadline_at = time.monotonic() + args.wait
+    try:
+        for backend in backend_pool.backends:
+            # A backend busy serving the Space is fine to share
+            wait_for_health(backend.url, deadline_at, ready_statuses=ROUTABLE_STATUSES)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = os.path.join(args.output_dir, RESULTS_MANIFEST)
+    finished = load_finished(results_path)
+    results = ResultsWriter(results_path)
+    output_store = get_output_store()
+
+    def run(item_id, image_path, preset):
+        record = {"id": item_id, "image": image_path, "preset": preset}
+        start = time.perf_counter()
+        try:
+            values = dict(zip(names, defaults), image=image_path, **presets[preset])
+            payload = build_payload(names, [values[key] for key in names])
+            json_response = request_prediction(
+                backend_pool,
+                payload,
+                {"Content-Type": "application/json"},
+                affinity=hash_file(image_path),
+                priority=BULK,
+            )
+            outputs = process_outputs(
+                parse_outputs(json_response["output"]), passthrough=True
+            )
+            destination_dir = os.path.join(args.output_dir, item_id)
+            os.makedirs(destination_dir, exist_ok=True)
+            written = []
+            for index, path in enumerate(outputs):
+                suffix = f"-{index}" if len(outputs) > 1 else ""
+                destination = os.path.join(
+                    destination_dir, f"{preset}{suffix}{os.path.splitext(path)[1]}"
+                )
+                shutil.move(path, destination)
+                output_store.discard(path)
+                written.append(destination)
+            record.update(status="ok", output=written[0])
+            if len(written) > 1:
+                record["outputs"] = written
+        except (gr.Error, OSError, LookupError, ValueError) as e:
+            record.update(status="error", error=str(e))
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        results.write(record)
+
+    # Bound the backlog too, so a huge manifest is streamed rather than
+    # turned into futures all at once
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    items = iter_manifest(args.manifest) if args.manifest else iter_directory(args.input_dir)
+    skipped = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for item_id, image_path in items:
+            # Presets of one image run back to back so its encoding and
+            # backend affinity are reused
+            for preset in presets:
+                if (item_id, preset) in finished:
+                    skipped += 1
+                    continue
+                slots.acquire()
+                future = executor.submit(run, item_id, image_path, preset)
+                future.add_done_callback(lambda _: slots.release())
+    results.close()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{results.ok} rendered, {results.failed} failed, {skipped} already done "
+        f"in {elapsed:.1f}s; results in {results_path}"
+    )
+    return 1 if results.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
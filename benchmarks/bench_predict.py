@@ -0,0 +1,205 @@
+"""Measure the frontend's request path against benchmarks/fake_cog.py.
+
+    python benchmarks/bench_predict.py --concurrency 1 4 10 32 --requests 200
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def wait_until_ready(url, timeout=30):
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/health-check", timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"Fake Cog server at {url} did not start")
+
+
+def make_input_image():
+    from PIL import Image
+
+    path = os.path.join(tempfile.mkdtemp(), "input.png")
+    Image.new("RGB", (512, 512), (200, 160, 140)).save(path)
+    return path
+
+
+def load_app_predict():
+    import app
+
+    return app.predict, app.names
+
+
+def load_dynamic_predict(api_url):
+    import gradio as gr
+    from utils.gradio_helpers import create_dynamic_gradio_app
+
+    import app
+
+    inputs = [gr.Image(type="filepath")] + [gr.Number() for _ in app.names[1:]]
+    interface = create_dynamic_gradio_app(
+        inputs, [gr.Image()], api_url, names=app.names, local_base=True
+    )
+    return interface.fn, app.names
+
+
+def default_args(names, image_path, index):
+    import app
+
+    values = {}
+    for component, key in zip(app.inputs, names):
+        values[key] = component.value
+    values["image"] = image_path
+    # Vary one slider so requests can't be served from the result cache
+    values["smile"] = round((index % 160) / 100 - 0.3, 2)
+    return [values[key] for key in names]
+
+
+def run_level(predict, names, image_path, concurrency, total):
+    # predict is a coroutine function, so every caller shares one event loop
+    latencies = []
+    errors = []
+    peak_threads = [threading.active_count()]
+
+    async def one(index, semaphore):
+        async with semaphore:
+            request = types.SimpleNamespace(session_hash=None, url="http://127.0.0.1:7860/")
+            args = default_args(names, image_path, index)
+            start = time.perf_counter()
+            try:
+                await predict(request, *args)
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                peak_threads[0] = max(peak_threads[0], threading.active_count())
+            latencies.append(time.perf_counter() - start)
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(one(index, semaphore) for index in range(total)))
+
+    start = time.perf_counter()
+    asyncio.run(run_all())
+    elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed, peak_threads[0]
+
+
+def measure_decode(cog_url, iterations=20):
+    import requests
+    from utils.gradio_helpers import iter_outputs, process_outputs
+
+    output = requests.post(
+        f"{cog_url}/predictions", json={"input": {}}, timeout=60
+    ).json()["output"]
+    timings = {}
+    for passthrough in (True, False):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            values = process_outputs(iter_outputs(output), passthrough=passthrough)
+            if not passthrough:
+                values[0].load()
+        timings[passthrough] = (time.perf_counter() - start) / iterations
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", choices=["app", "dynamic"], default="app")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 10, 32])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--threads", type=int, default=10)
+    parser.add_argument("--output-bytes", type=int, default=200000)
+    parser.add_argument("--completion-mode", default=None)
+    parser.add_argument("--cache", action="store_true", help="keep the result cache on")
+    args = parser.parse_args()
+
+    cog_url = f"http://127.0.0.1:{args.port}"
+    os.environ["COG_API_URL"] = cog_url
+    if args.completion_mode:
+        os.environ["COG_COMPLETION_MODE"] = args.completion_mode
+    if not args.cache:
+        os.environ["RESULT_CACHE_SIZE"] = "0"
+
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, "benchmarks", "fake_cog.py"),
+            "--port", str(args.port),
+            "--latency", str(args.latency),
+            "--jitter", str(args.jitter),
+            "--threads", str(args.threads),
+            "--output-bytes", str(args.output_bytes),
+        ]
+    )
+    try:
+        import requests
+
+        wait_until_ready(cog_url)
+        if args.target == "app":
+            predict, names = load_app_predict()
+        else:
+            predict, names = load_dynamic_predict(f"{cog_url}/predictions")
+        image_path = make_input_image()
+        # Warm up connections, hashing and the input encoding
+        run_level(predict, names, image_path, 1, 2)
+
+        print(
+            f"target={args.target} model_latency={args.latency}s "
+            f"output_bytes={args.output_bytes}"
+        )
+        print("conc  reqs  errs  p50_ms  p95_ms  p99_ms   req/s  polls/req  409s  threads")
+        for concurrency in args.concurrency:
+            before = requests.get(f"{cog_url}/stats", timeout=5).json()
+            latencies, errors, elapsed, threads = run_level(
+                predict, names, image_path, concurrency, args.requests
+            )
+            after = requests.get(f"{cog_url}/stats", timeout=5).json()
+            if not latencies:
+                print(f"{concurrency:>4}  all {len(errors)} requests failed: {errors[0]}")
+                continue
+            polls = (after["polls"] - before["polls"]) / len(latencies)
+            conflicts = after["conflicts"] - before["conflicts"]
+            print(
+                f"{concurrency:>4}  {len(latencies):>4}  {len(errors):>4}  "
+                f"{percentile(latencies, 0.50) * 1000:>6.1f}  "
+                f"{percentile(latencies, 0.95) * 1000:>6.1f}  "
+                f"{percentile(latencies, 0.99) * 1000:>6.1f}  "
+                f"{len(latencies) / elapsed:>6.1f}  {polls:>9.2f}  {conflicts:>4}  {threads:>7}"
+            )
+
+        decode = measure_decode(cog_url)
+        print(f"decode passthrough={decode[True] * 1000:.2f}ms pil={decode[False] * 1000:.2f}ms")
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"peak_rss={peak_rss:.1f}MiB")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
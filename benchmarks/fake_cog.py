@@ -0,0 +1,154 @@
+"""Stand-in Cog server for benchmarking the frontend without a GPU.
+
+    python benchmarks/fake_cog.py --port 5055 --latency 0.3 --output-bytes 200000
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from PIL import Image
+
+
+def make_output(output_bytes, output_format="webp"):
+    # Noise doesn't compress, so the encoded size tracks the pixel count
+    side = max(int((output_bytes / 3) ** 0.5), 8)
+    image = Image.frombytes("RGB", (side, side), random.randbytes(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP" if output_format == "webp" else "PNG", lossless=True)
+    encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+    mime_type = "image/webp" if output_format == "webp" else "image/png"
+    return f"data:{mime_type};base64,{encoded}"
+
+
+class FakeCog:
+    def __init__(self, latency, jitter, threads, output):
+        self.latency = latency
+        self.jitter = jitter
+        self.threads = threads
+        self.output = output
+        self.predictions = {}
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.stats = {"created": 0, "polls": 0, "conflicts": 0, "cancels": 0}
+
+    def admit(self):
+        with self.lock:
+            if self.busy >= self.threads:
+                self.stats["conflicts"] += 1
+                return False
+            self.busy += 1
+            self.stats["created"] += 1
+            return True
+
+    def run(self, prediction, webhook=None):
+        deadline = time.monotonic() + max(
+            self.latency + random.uniform(-self.jitter, self.jitter), 0
+        )
+        while time.monotonic() < deadline and prediction["status"] != "canceled":
+            time.sleep(min(0.01, max(deadline - time.monotonic(), 0)))
+        with self.lock:
+            self.busy -= 1
+        if prediction["status"] != "canceled":
+            prediction["output"] = self.output
+            prediction["status"] = "succeeded"
+        prediction["completed_at"] = time.time()
+        if webhook:
+            try:
+                requests.post(webhook, json=prediction, timeout=5)
+            except requests.exceptions.RequestException:
+                pass
+
+
+def make_handler(cog, base_url):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path == "/health-check":
+                return self.send_json(200, {"status": "READY"})
+            if self.path == "/stats":
+                return self.send_json(200, cog.stats)
+            match = re.fullmatch(r"/predictions/([^/]+)", self.path)
+            if match and match.group(1) in cog.predictions:
+                with cog.lock:
+                    cog.stats["polls"] += 1
+                return self.send_json(200, cog.predictions[match.group(1)])
+            self.send_json(404, {"detail": "Not Found"})
+
+        def do_POST(self):
+            body = self.read_json()
+            match = re.fullmatch(r"/predictions/([^/]+)/cancel", self.path)
+            if match:
+                prediction = cog.predictions.get(match.group(1))
+                if prediction is None:
+                    return self.send_json(404, {"detail": "Not Found"})
+                with cog.lock:
+                    cog.stats["cancels"] += 1
+                prediction["status"] = "canceled"
+                return self.send_json(200, {})
+            if self.path != "/predictions":
+                return self.send_json(404, {"detail": "Not Found"})
+            if not cog.admit():
+                return self.send_json(409, {"detail": "Already running a prediction"})
+            prediction_id = body.get("id") or uuid.uuid4().hex
+            prediction = {
+                "id": prediction_id,
+                "input": body.get("input", {}),
+                "output": None,
+                "status": "processing",
+                "created_at": time.time(),
+                "urls": {"get": f"{base_url}/predictions/{prediction_id}"},
+            }
+            cog.predictions[prediction_id] = prediction
+            if self.headers.get("Prefer") == "respond-async":
+                threading.Thread(
+                    target=cog.run, args=(prediction, body.get("webhook")), daemon=True
+                ).start()
+                return self.send_json(202, prediction)
+            cog.run(prediction)
+            self.send_json(200, prediction)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=5055, latency=0.3, jitter=0.05, threads=10, output_bytes=200000):
+    cog = FakeCog(latency, jitter, threads, make_output(output_bytes))
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", port), make_handler(cog, f"http://127.0.0.1:{port}")
+    )
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--threads", type=int, default=10)
+    parser.add_argument("--output-bytes", type=int, default=200000)
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.jitter, args.threads, args.output_bytes)
@@ -1,44 +1,13 @@
-# Start the cog server in the background - Ensure correct path to cog
-cd /src && python3 -m cog.server.http --threads=10 &
-
-# Initialize counter for the first loop
-counter1=0
-
-# Continuous loop for reliably checking cog server's readiness on port 5000
-while true; do
-  if nc -z localhost 5000; then
-    echo "Cog server is running on port 5000."
-    break  # Exit the loop when the server is up
-  fi
-  echo "Waiting for cog server to start on port 5000..."
-  sleep 5
-  ((counter1++))
-  if [ $counter1 -ge 250 ]; then
-    echo "Error: Cog server did not start on port 5000 after 250 attempts."
-    exit 1  # Exit the script with an error status
-  fi
-done
-
-# Initialize counter for the second loop
-counter2=0
-
-# New check: Waiting for the cog server to be fully ready
-while true; do
-  response=$(curl -s http://localhost:5000/health-check) # Replace localhost:5000 with actual hostname and port if necessary
-  status=$(echo $response | jq -r '.status') # Parse status from JSON response
-  if [ "$status" = "READY" ]; then
-    echo "Cog server is fully ready."
-    break # Exit the loop when the server is fully ready
-  else
-    echo "Waiting for cog server (models loading) on port 5000..."
-    sleep 5
-  fi
-  ((counter2++))
-  if [ $counter2 -ge 250 ]; then
-    echo "Error: Cog server did not become fully ready after 250 attempts."
-    exit 1  # Exit the script with an error status
-  fi
-done
-
-# Run the application - only when cog server is fully ready
-cd $HOME/app && . $HOME/.venv/bin/activate && python app.py
\ No newline at end of file
+# The cog server runs on the image's own python, resolve it before the venv
+# shadows python3. With OUTPUT_SINK=1 output files are PUT to the frontend's
+# sink instead of coming back base64-encoded inside the prediction JSON; only
+# turn it on for a Cog that sends X-Prediction-ID or honours Location.
+UPLOAD_URL_ARG=""
+if [ "${OUTPUT_SINK:-0}" = "1" ]; then
+    UPLOAD_URL_ARG="--upload-url=http://127.0.0.1:${GRADIO_SERVER_PORT:-7860}/cog-upload/"
+fi
+export COG_COMMAND="$(command -v python3) -m cog.server.http --threads=10 ${UPLOAD_URL_ARG}"
+
+# Start the cog server and the Gradio app together; the supervisor waits for
+# the model to load, warms it up and exits with an error if Cog never gets ready
+cd $HOME/app && . $HOME/.venv/bin/activate && python supervisor.py
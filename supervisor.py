@@ -0,0 +1,80 @@
+import atexit
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+from utils.startup import (
+    COG_STARTUP_TIMEOUT,
+    make_warm_up_image,
+    startup_state,
+    wait_for_health,
+    warm_up,
+)
+
+# Needs a Cog that sends X-Prediction-ID or honours the sink's Location header
+OUTPUT_SINK = os.environ.get("OUTPUT_SINK", "0") == "1"
+COG_COMMAND = os.environ.get(
+    "COG_COMMAND",
+    "python3 -m cog.server.http --threads=10"
+    + (
+        f" --upload-url=http://127.0.0.1:{os.environ.get('GRADIO_SERVER_PORT', 7860)}/cog-upload/"
+        if OUTPUT_SINK
+        else ""
+    ),
+)
+COG_DIR = os.environ.get("COG_DIR", "/src")
+# Set to 0 when Cog is started elsewhere, e.g. on other machines
+START_COG = os.environ.get("START_COG", "1") == "1"
+
+
+def start_cog():
+    process = subprocess.Popen(shlex.split(COG_COMMAND), cwd=COG_DIR)
+    atexit.register(process.terminate)
+    return process
+
+
+def prepare_backends(app, process):
+    from utils.backends import get_backend_pool
+    from utils.gradio_helpers import build_payload
+
+    deadline_at = time.monotonic() + COG_STARTUP_TIMEOUT
+    try:
+        backend_urls = [backend.url for backend in get_backend_pool().backends]
+        for base_url in backend_urls:
+            wait_for_health(base_url, deadline_at, process)
+        print("Cog server is fully ready.")
+        startup_state.set("warming")
+        args = [component.value for component in app.inputs]
+        args[app.names.index("image")] = make_warm_up_image()
+        payload = build_payload(app.names, args)
+        threads = [
+            threading.Thread(target=warm_up, args=(base_url, payload))
+            for base_url in backend_urls
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        startup_state.set("ready")
+        print("Warm-up finished, serving predictions.")
+    except RuntimeError as e:
+        startup_state.set("failed", str(e))
+        print(f"Error: {e}")
+        # Same outcome as run.sh giving up: let the container restart
+        os._exit(1)
+
+
+def main():
+    startup_state.set("starting")
+    process = start_cog() if START_COG else None
+    # Importing Gradio and building the UI overlaps with Cog loading the model
+    import app
+
+    threading.Thread(target=prepare_backends, args=(app, process), daemon=True).start()
+    app.launch()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from utils.admission import (
+    BULK,
+    INTERACTIVE,
+    SUBMIT,
+    AdmissionController,
+    AdmissionError,
+)
+
+
+def dispatch_order(controller, requests):
+    # Queues requests ((tag, session, priority), ...) behind every slot being
+    # taken, then frees the slots and returns the tags in admission order
+    order = []
+
+    async def run(tag, session, priority):
+        grant = await controller.acquire_async(session=session, priority=priority)
+        order.append(tag)
+        await asyncio.sleep(0)
+        controller.release(grant)
+
+    async def main():
+        held = [controller.acquire() for _ in range(controller.capacity)]
+        tasks = []
+        for tag, session, priority in requests:
+            tasks.append(asyncio.ensure_future(run(tag, session, priority)))
+            await asyncio.sleep(0)
+        for grant in held:
+            controller.release(grant)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    return order
+
+
+def test_interactive_edit_skips_own_bulk_backlog():
+    controller = AdmissionController(capacity=1, session_inflight=1)
+    requests = [(f"bulk{i}", "a", BULK) for i in range(10)]
+    requests.append(("edit", "a", INTERACTIVE))
+    order = dispatch_order(controller, requests)
+    assert order[0] == "edit"
+    assert order[1:] == [f"bulk{i}" for i in range(10)]
+
+
+def test_sessions_take_turns_within_a_class():
+    controller = AdmissionController(capacity=1, session_inflight=1)
+    requests = [(f"a{i}", "a", SUBMIT) for i in range(3)]
+    requests += [(f"b{i}", "b", SUBMIT) for i in range(3)]
+    assert dispatch_order(controller, requests) == ["a0", "b0", "a1", "b1", "a2", "b2"]
+
+
+def test_submits_overtake_another_sessions_bulk():
+    controller = AdmissionController(capacity=1, session_inflight=1)
+    requests = [(f"bulk{i}", "a", BULK) for i in range(4)]
+    requests += [(f"submit{i}", "b", SUBMIT) for i in range(2)]
+    order = dispatch_order(controller, requests)
+    assert order[:2] == ["submit0", "submit1"]
+    assert order[2:] == [f"bulk{i}" for i in range(4)]
+
+
+def test_session_inflight_limit_leaves_slots_for_others():
+    controller = AdmissionController(capacity=4, session_inflight=2)
+    grants = [controller.acquire(session="a", priority=BULK) for _ in range(2)]
+    with pytest.raises(AdmissionError):
+        controller.acquire(session="a", priority=BULK, abandoned=lambda: True)
+    grants += [controller.acquire(session="b") for _ in range(2)]
+    assert controller.stats()["inflight"] == 4
+    for grant in grants:
+        controller.release(grant)
+
+
+def test_anonymous_callers_are_not_session_limited():
+    controller = AdmissionController(capacity=4, session_inflight=1)
+    grants = [controller.acquire(abandoned=lambda: True) for _ in range(4)]
+    assert controller.stats()["sessions_inflight"] == 1
+    for grant in grants:
+        controller.release(grant)
+
+
+def test_session_queue_limit_rejects():
+    controller = AdmissionController(capacity=1, session_queue=2)
+    held = controller.acquire(session="other")
+    waiters = [controller._enqueue("a", BULK) for _ in range(2)]
+    with pytest.raises(AdmissionError):
+        controller._enqueue("a", BULK)
+    assert controller.stats()["rejected"] == 1
+    assert controller.stats()["max_session_queued"] == 2
+    for waiter in waiters:
+        controller._discard(waiter)
+    controller.release(held)
+
+
+def test_stats_settle_after_release():
+    controller = AdmissionController(capacity=1)
+    requests = [("edit", "a", INTERACTIVE), ("bulk", "b", BULK)]
+    dispatch_order(controller, requests)
+    stats = controller.stats()
+    assert stats["inflight"] == 0
+    assert stats["queued"] == 0
+    assert stats["sessions_inflight"] == 0
+    assert stats["admitted"] == 3
+    assert controller._finish_tags == {}
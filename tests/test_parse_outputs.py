@@ -0,0 +1,95 @@
+import sys
+
+import pytest
+
+from utils.gradio_helpers import iter_outputs, parse_outputs
+
+
+def recursive_parse_outputs(data):
+    # The recursive implementation iter_outputs replaced, kept as the oracle
+    if isinstance(data, dict):
+        dict_values = []
+        for value in data.values():
+            extracted_values = recursive_parse_outputs(value)
+            if isinstance(value, list):
+                dict_values += [extracted_values]
+            else:
+                dict_values += extracted_values
+        return dict_values
+    elif isinstance(data, list):
+        list_values = []
+        for item in data:
+            list_values += recursive_parse_outputs(item)
+        return list_values
+    else:
+        return [data]
+
+
+CASES = [
+    "https://example.com/out.png",
+    1.5,
+    None,
+    "",
+    ["a.png", "b.png"],
+    {"image": "a.png", "score": 0.9},
+    {"images": ["a.png", "b.png"], "caption": "text"},
+    [{"image": "a.png"}, {"image": "b.png"}],
+    [["a", ["b", ["c"]]], "d"],
+    {"outer": {"inner": ["a", {"deep": ["b", "c"]}]}},
+    [{"frames": [["a", "b"], {"x": ["c"]}]}, "d"],
+    [],
+    {},
+    [[], {}, [[]]],
+    {"empty_list": [], "empty_dict": {}, "value": 1},
+    {"nested": {"list": [[], [{}]]}},
+    [None, "", 0, False],
+    {"a": None, "b": "", "c": [None, ""]},
+]
+
+
+@pytest.mark.parametrize("data", CASES)
+def test_matches_recursive_implementation(data):
+    assert parse_outputs(data) == recursive_parse_outputs(data)
+
+
+@pytest.mark.parametrize("data", CASES)
+def test_iter_outputs_yields_the_same_values(data):
+    assert list(iter_outputs(data)) == recursive_parse_outputs(data)
+
+
+def test_moderate_alternating_nesting_matches():
+    data = "leaf"
+    for depth in range(100):
+        data = [{"level": data, "index": depth}] if depth % 2 else {"items": [data]}
+    assert parse_outputs(data) == recursive_parse_outputs(data)
+
+
+DEEP = sys.getrecursionlimit() * 3
+
+
+def test_deep_lists_flatten_past_the_recursion_limit():
+    data = "leaf"
+    for _ in range(DEEP):
+        data = [data]
+    assert parse_outputs(data) == ["leaf"]
+
+
+def test_deep_dicts_flatten_past_the_recursion_limit():
+    data = "leaf"
+    for _ in range(DEEP):
+        data = {"child": data}
+    assert parse_outputs(data) == ["leaf"]
+
+
+def test_deep_lists_in_dicts_stay_grouped_past_the_recursion_limit():
+    # Each list directly inside an object keeps one level of grouping
+    data = "leaf"
+    for _ in range(DEEP):
+        data = {"child": [data]}
+    # Unwrap iteratively, == on nested lists recurses as well; the returned
+    # list itself is one more level
+    result = parse_outputs(data)
+    for _ in range(DEEP + 1):
+        assert isinstance(result, list) and len(result) == 1
+        result = result[0]
+    assert result == "leaf"
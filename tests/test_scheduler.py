@@ -0,0 +1,39 @@
+from utils.scheduler import LatestWinsScheduler
+
+
+def test_newest_ticket_is_current():
+    scheduler = LatestWinsScheduler(debounce=0)
+    old = scheduler.begin("session")
+    new = scheduler.begin("session")
+    assert not scheduler.is_current(old)
+    assert scheduler.is_current(new)
+    assert scheduler.superseded == 1
+
+
+def test_session_state_dropped_when_renders_finish_out_of_order():
+    scheduler = LatestWinsScheduler(debounce=0)
+    old = scheduler.begin("session")
+    new = scheduler.begin("session")
+    scheduler.finish(new)
+    scheduler.finish(old)
+    assert scheduler._sessions == {}
+
+
+def test_finished_tickets_never_become_current_again():
+    scheduler = LatestWinsScheduler(debounce=0)
+    old = scheduler.begin("session")
+    scheduler.finish(old)
+    new = scheduler.begin("session")
+    assert not scheduler.is_current(old)
+    assert scheduler.is_current(new)
+
+
+def test_superseding_cancels_every_prediction_of_a_ticket():
+    scheduler = LatestWinsScheduler(debounce=0)
+    cancelled = []
+    old = scheduler.begin("session")
+    scheduler.attach(old, lambda: cancelled.append("preview"))
+    scheduler.attach(old, lambda: cancelled.append("final"))
+    scheduler.begin("session")
+    assert cancelled == ["preview", "final"]
+    assert scheduler.cancelled == 2
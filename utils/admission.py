@@ -0,0 +1,318 @@
+import asyncio
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, wait
+
+from utils import cog_client
+from utils.backends import get_backend_pool
+
+
+# Defaults to one slot per Cog worker thread across all backends
+ADMISSION_CAPACITY = int(os.environ.get("ADMISSION_CAPACITY", 0))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 64))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", 120))
+ADMISSION_CONFLICT_RETRIES = int(os.environ.get("ADMISSION_CONFLICT_RETRIES", 6))
+ADMISSION_RETRY_BASE = float(os.environ.get("ADMISSION_RETRY_BASE", 0.25))
+ADMISSION_RETRY_MAX = float(os.environ.get("ADMISSION_RETRY_MAX", 4))
+# Slots one session may hold at once; 0 means half the capacity
+ADMISSION_SESSION_INFLIGHT = int(os.environ.get("ADMISSION_SESSION_INFLIGHT", 0))
+# Requests one session may have queued; 0 means enough for a sweep or an
+# animation's window of frames
+ADMISSION_SESSION_QUEUE = int(os.environ.get("ADMISSION_SESSION_QUEUE", 0))
+# How often a queued caller re-checks its position and whether it was abandoned
+ADMISSION_TICK = 0.25
+
+INTERACTIVE = "interactive"
+SUBMIT = "submit"
+BULK = "bulk"
+# Relative share of the slots each class gets while all of them are waiting
+PRIORITY_WEIGHTS = {
+    INTERACTIVE: float(os.environ.get("ADMISSION_WEIGHT_INTERACTIVE", 8)),
+    SUBMIT: float(os.environ.get("ADMISSION_WEIGHT_SUBMIT", 4)),
+    BULK: float(os.environ.get("ADMISSION_WEIGHT_BULK", 1)),
+}
+# Callers without a session, e.g. a standalone batch run, share this one and
+# are not held to the per-session limit
+ANONYMOUS = "anonymous"
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class Waiter:
+    def __init__(self, session, priority, start, finish, sequence):
+        self.session = session
+        self.priority = priority
+        self.start = start
+        self.finish = finish
+        self.sequence = sequence
+        self.future = Future()
+
+    def order(self):
+        return (self.finish, self.sequence)
+
+
+class AdmissionController:
+    # Weighted fair queuing over sessions: every request gets a virtual
+    # finish tag that grows with its session's backlog in the same class and
+    # shrinks with the class weight, and free slots go to the smallest tag
+    # whose session is below its in-flight limit. Tags are kept per class so
+    # a session's slider edits don't queue behind its own sweep
+    def __init__(
+        self,
+        capacity=cog_client.COG_POOL_SIZE,
+        max_queue=ADMISSION_MAX_QUEUE,
+        max_wait=ADMISSION_MAX_WAIT,
+        session_inflight=ADMISSION_SESSION_INFLIGHT,
+        session_queue=ADMISSION_SESSION_QUEUE,
+    ):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.session_inflight = session_inflight or max(1, capacity // 2)
+        self.session_queue = session_queue or max(16, capacity * 2)
+        self._inflight = 0
+        self._waiters = []
+        self._session_inflight = {}
+        self._finish_tags = {}
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.conflict_retries = 0
+
+    def acquire(self, on_position=None, abandoned=None, session=None, priority=SUBMIT):
+        # Returns the grant to pass to release() or run_admitted()
+        waiter = self._enqueue(session, priority)
+        if waiter.future.done():
+            return waiter
+        deadline = time.monotonic() + self.max_wait
+        last_position = None
+        while True:
+            last_position = self._report_position(waiter, on_position, last_position)
+            remaining = deadline - time.monotonic()
+            give_up = remaining <= 0 or (abandoned is not None and abandoned())
+            if give_up:
+                return self._give_up(waiter, remaining)
+            if wait([waiter.future], timeout=min(ADMISSION_TICK, remaining)).done:
+                return waiter
+
+    async def acquire_async(
+        self, on_position=None, abandoned=None, session=None, priority=SUBMIT
+    ):
+        # Same as acquire, but a queued caller waits without holding a thread
+        waiter = self._enqueue(session, priority)
+        if waiter.future.done():
+            return waiter
+        handed_over = asyncio.wrap_future(waiter.future)
+        deadline = time.monotonic() + self.max_wait
+        last_position = None
+        try:
+            while True:
+                last_position = self._report_position(
+                    waiter, on_position, last_position
+                )
+                remaining = deadline - time.monotonic()
+                give_up = remaining <= 0 or (abandoned is not None and abandoned())
+                if give_up:
+                    return self._give_up(waiter, remaining)
+                await asyncio.wait(
+                    [handed_over], timeout=min(ADMISSION_TICK, remaining)
+                )
+                if waiter.future.done():
+                    return waiter
+        except asyncio.CancelledError:
+            # The event was cancelled, e.g. the browser went away
+            self._discard(waiter)
+            raise
+
+    def release(self, grant):
+        with self._lock:
+            self._inflight -= 1
+            remaining = self._session_inflight.get(grant.session, 0) - 1
+            if remaining > 0:
+                self._session_inflight[grant.session] = remaining
+            else:
+                self._session_inflight.pop(grant.session, None)
+                self._forget(grant.session)
+            self._dispatch()
+
+    def _enqueue(self, session, priority):
+        # Queues a waiter and hands out any free slots; the returned waiter's
+        # future is already resolved when it got one straight away
+        session = session or ANONYMOUS
+        with self._lock:
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionError("The queue is full")
+            queued = sum(1 for waiter in self._waiters if waiter.session == session)
+            if session != ANONYMOUS and queued >= self.session_queue:
+                self.rejected += 1
+                raise AdmissionError("Too many requests queued for this session")
+            flow = (session, priority)
+            start = max(self._virtual_time, self._finish_tags.get(flow, 0.0))
+            finish = start + 1 / PRIORITY_WEIGHTS[priority]
+            self._finish_tags[flow] = finish
+            waiter = Waiter(session, priority, start, finish, next(self._sequence))
+            self._waiters.append(waiter)
+            self._dispatch()
+            return waiter
+
+    def _eligible(self, waiter):
+        if waiter.session == ANONYMOUS:
+            return True
+        return self._session_inflight.get(waiter.session, 0) < self.session_inflight
+
+    def _dispatch(self):
+        # Called with the lock held
+        while self._inflight < self.capacity:
+            eligible = [waiter for waiter in self._waiters if self._eligible(waiter)]
+            if not eligible:
+                return
+            waiter = min(eligible, key=Waiter.order)
+            self._waiters.remove(waiter)
+            self._inflight += 1
+            self._session_inflight[waiter.session] = (
+                self._session_inflight.get(waiter.session, 0) + 1
+            )
+            self._virtual_time = max(self._virtual_time, waiter.start)
+            self.admitted += 1
+            waiter.future.set_result(True)
+
+    def _forget(self, session):
+        # Drop an idle session's tags; it restarts from the virtual time
+        if session in self._session_inflight:
+            return
+        if any(waiter.session == session for waiter in self._waiters):
+            return
+        for priority in PRIORITY_WEIGHTS:
+            self._finish_tags.pop((session, priority), None)
+
+    def _report_position(self, waiter, on_position, last_position):
+        with self._lock:
+            position = 0
+            if waiter in self._waiters:
+                order = waiter.order()
+                position = 1 + sum(1 for other in self._waiters if other.order() < order)
+        if position and on_position is not None and position != last_position:
+            on_position(position)
+            return position
+        return last_position
+
+    def _give_up(self, waiter, remaining):
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._forget(waiter.session)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise AdmissionError("Timed out waiting for a free slot")
+                raise AdmissionError("Abandoned while queued")
+        if remaining <= 0:
+            # The slot was handed over just as the wait ran out
+            return waiter
+        self.release(waiter)
+        raise AdmissionError("Abandoned while queued")
+
+    def _discard(self, waiter):
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._forget(waiter.session)
+                return
+        # A slot was already handed to this waiter, pass it on
+        self.release(waiter)
+
+    def run(self, fn, on_position=None, abandoned=None, session=None, priority=SUBMIT):
+        grant = self.acquire(on_position, abandoned, session, priority)
+        return self.run_admitted(fn, grant, abandoned)
+
+    def run_admitted(self, fn, grant, abandoned=None):
+        # Runs fn in the slot granted by acquire() and frees it after
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return fn()
+                except cog_client.PredictionError as e:
+                    if e.status_code != 409 or attempt >= ADMISSION_CONFLICT_RETRIES:
+                        raise
+                # Cog is busier than we think, e.g. another client uses it
+                with self._lock:
+                    self.conflict_retries += 1
+                delay = min(ADMISSION_RETRY_BASE * 2**attempt, ADMISSION_RETRY_MAX)
+                time.sleep(random.uniform(0, delay))
+                attempt += 1
+                if abandoned is not None and abandoned():
+                    raise AdmissionError("Abandoned while retrying")
+        finally:
+            self.release(grant)
+
+    async def run_admitted_async(self, fn, grant, abandoned=None):
+        # fn is a coroutine function; retries sleep without holding a thread
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return await fn()
+                except cog_client.PredictionError as e:
+                    if e.status_code != 409 or attempt >= ADMISSION_CONFLICT_RETRIES:
+                        raise
+                with self._lock:
+                    self.conflict_retries += 1
+                delay = min(ADMISSION_RETRY_BASE * 2**attempt, ADMISSION_RETRY_MAX)
+                await asyncio.sleep(random.uniform(0, delay))
+                attempt += 1
+                if abandoned is not None and abandoned():
+                    raise AdmissionError("Abandoned while retrying")
+        finally:
+            self.release(grant)
+
+    def stats(self):
+        with self._lock:
+            queued_by_session = {}
+            for waiter in self._waiters:
+                queued_by_session[waiter.session] = (
+                    queued_by_session.get(waiter.session, 0) + 1
+                )
+            stats = {
+                "capacity": self.capacity,
+                "inflight": self._inflight,
+                "queued": len(self._waiters),
+                "sessions_inflight": len(self._session_inflight),
+                "sessions_queued": len(queued_by_session),
+                "max_session_queued": max(queued_by_session.values(), default=0),
+                "session_limited": sum(
+                    1 for waiter in self._waiters if not self._eligible(waiter)
+                ),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "conflict_retries": self.conflict_retries,
+            }
+            for priority in PRIORITY_WEIGHTS:
+                stats[f"queued_{priority}"] = sum(
+                    1 for waiter in self._waiters if waiter.priority == priority
+                )
+            return stats
+
+
+_admission_controller = None
+_admission_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    global _admission_controller
+    if _admission_controller is None:
+        with _admission_controller_lock:
+            if _admission_controller is None:
+                _admission_controller = AdmissionController(
+                    capacity=ADMISSION_CAPACITY or get_backend_pool().capacity
+                )
+    return _admission_controller
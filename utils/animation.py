@@ -0,0 +1,186 @@
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from PIL import Image
+
+from utils.output_store import get_output_store
+
+
+ANIMATION_MAX_FRAMES = int(os.environ.get("ANIMATION_MAX_FRAMES", 240))
+FFMPEG = os.environ.get("FFMPEG", "ffmpeg")
+
+
+class KeyframeError(ValueError):
+    pass
+
+
+def parse_keyframes(text, frame_count, parameter_names):
+    try:
+        keyframes = json.loads(text)
+    except ValueError as e:
+        raise KeyframeError(f"Keyframes are not valid JSON: {e}")
+    if not isinstance(keyframes, list) or not keyframes:
+        raise KeyframeError("Keyframes must be a non-empty JSON list")
+    parsed = []
+    for keyframe in keyframes:
+        if not isinstance(keyframe, dict) or "frame" not in keyframe:
+            raise KeyframeError('Every keyframe needs a "frame" number')
+        try:
+            frame = int(keyframe["frame"])
+        except (TypeError, ValueError):
+            raise KeyframeError(f"Keyframe frame {keyframe['frame']!r} is not a number")
+        if not 0 <= frame < frame_count:
+            raise KeyframeError(f"Keyframe {frame} is outside 0..{frame_count - 1}")
+        values = {}
+        for key, value in keyframe.items():
+            if key == "frame":
+                continue
+            if key not in parameter_names:
+                raise KeyframeError(f"Unknown parameter {key!r}")
+            try:
+                values[key] = float(value)
+            except (TypeError, ValueError):
+                raise KeyframeError(f"{key} must be a number, got {value!r}")
+        parsed.append((frame, values))
+    return sorted(parsed, key=lambda keyframe: keyframe[0])
+
+
+def smoothstep(t):
+    return t * t * (3 - 2 * t)
+
+
+def interpolate_frames(keyframes, frame_count, base_values):
+    # Parameters a keyframe leaves out hold the base (current slider) value
+    resolved = [(frame, dict(base_values, **values)) for frame, values in keyframes]
+    for index in range(frame_count):
+        if index <= resolved[0][0]:
+            yield dict(resolved[0][1])
+            continue
+        if index >= resolved[-1][0]:
+            yield dict(resolved[-1][1])
+            continue
+        for (start, start_values), (end, end_values) in zip(resolved, resolved[1:]):
+            if start <= index <= end:
+                t = smoothstep((index - start) / (end - start))
+                yield {
+                    key: round(value + (end_values[key] - value) * t, 4)
+                    for key, value in start_values.items()
+                }
+                break
+
+
+class FrameEncoder:
+    # Feeds encoded frames to ffmpeg as they arrive, so nothing is decoded or
+    # held in this process
+    def __init__(self, fps, output_format):
+        self.output_format = output_format
+        self.output_store = get_output_store()
+        self.filename = self.output_store.new_path(f".{output_format}")
+        if output_format == "webp":
+            codec = ["-c:v", "libwebp", "-lossless", "0", "-q:v", "85", "-loop", "0"]
+        else:
+            codec = [
+                "-c:v", "libx264", "-pix_fmt", "yuv420p",
+                "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+                "-movflags", "+faststart",
+            ]
+        self.process = subprocess.Popen(
+            [FFMPEG, "-loglevel", "error", "-y", "-f", "image2pipe",
+             "-framerate", str(fps), "-i", "-", *codec, self.filename],
+            stdin=subprocess.PIPE,
+        )
+
+    def write(self, frame_path):
+        with open(frame_path, "rb") as frame:
+            shutil.copyfileobj(frame, self.process.stdin)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError("ffmpeg failed to encode the animation")
+        self.output_store.add(self.filename)
+        return self.filename
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class PillowFrameEncoder:
+    # Fallback without ffmpeg: animated webp through Pillow, which needs every
+    # frame at save time, so memory grows with the clip length
+    def __init__(self, fps, output_format):
+        self.duration = int(1000 / fps)
+        self.frames = []
+
+    def write(self, frame_path):
+        with Image.open(frame_path) as image:
+            self.frames.append(image.convert("RGB"))
+
+    def close(self):
+        output_store = get_output_store()
+        filename = output_store.new_path(".webp")
+        first, rest = self.frames[0], self.frames[1:]
+        first.save(
+            filename, save_all=True, append_images=rest,
+            duration=self.duration, loop=0, quality=85,
+        )
+        self.frames = []
+        output_store.add(filename)
+        return filename
+
+    def abort(self):
+        self.frames = []
+
+
+def create_encoder(fps, output_format):
+    if shutil.which(FFMPEG):
+        return FrameEncoder(fps, output_format)
+    return PillowFrameEncoder(fps, output_format)
+
+
+def render_animation(frames, render_frame, encoder, window, on_frame=None):
+    # At most `window` frames are rendering or waiting in the reorder buffer,
+    # and frames are handed to the encoder strictly in order
+    output_store = get_output_store()
+    total = len(frames)
+    pending = {}
+    ready = {}
+    next_submit = 0
+    next_encode = 0
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        try:
+            while next_encode < total:
+                while next_submit < total and next_submit - next_encode < window:
+                    future = executor.submit(render_frame, frames[next_submit])
+                    pending[future] = next_submit
+                    next_submit += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ready[pending.pop(future)] = future.result()
+                while next_encode in ready:
+                    frame_path = ready.pop(next_encode)
+                    encoder.write(frame_path)
+                    output_store.discard(frame_path)
+                    next_encode += 1
+                    if on_frame is not None:
+                        on_frame(next_encode, total)
+        except BaseException:
+            # Don't leave ffmpeg waiting on its stdin or a partial file behind
+            encoder.abort()
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+    return encoder.close()
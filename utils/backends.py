@@ -0,0 +1,182 @@
+import hashlib
+import os
+import threading
+import time
+
+import httpx
+import requests
+
+from utils import cog_client
+
+
+COG_API_URLS = [
+    url.strip().rstrip("/")
+    for url in os.environ.get("COG_API_URLS", cog_client.COG_API_URL).split(",")
+    if url.strip()
+]
+BACKEND_CAPACITY = int(os.environ.get("BACKEND_CAPACITY", cog_client.COG_POOL_SIZE))
+BACKEND_PROBE_INTERVAL = float(os.environ.get("BACKEND_PROBE_INTERVAL", 2))
+BACKEND_PROBE_TIMEOUT = float(os.environ.get("BACKEND_PROBE_TIMEOUT", 2))
+BACKEND_FAILURE_THRESHOLD = int(os.environ.get("BACKEND_FAILURE_THRESHOLD", 3))
+
+# Health-check states in which Cog accepts predictions
+ROUTABLE_STATUSES = ("READY", "BUSY")
+
+
+class Backend:
+    def __init__(self, url, capacity):
+        self.url = url
+        self.capacity = capacity
+        self.outstanding = 0
+        self.healthy = True
+        self.ejected = False
+        self.failures = 0
+        self.requests = 0
+
+    def load(self):
+        return self.outstanding / self.capacity
+
+
+class BackendPool:
+    def __init__(
+        self,
+        urls,
+        capacity=BACKEND_CAPACITY,
+        probe_interval=BACKEND_PROBE_INTERVAL,
+        failure_threshold=BACKEND_FAILURE_THRESHOLD,
+    ):
+        self.backends = [Backend(url.rstrip("/"), capacity) for url in urls]
+        self.capacity = capacity * len(self.backends)
+        self.probe_interval = probe_interval
+        self.failure_threshold = failure_threshold
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def start(self):
+        with self._lock:
+            if self._prober is not None:
+                return
+            self._prober = threading.Thread(target=self._probe_forever, daemon=True)
+        self._prober.start()
+
+    def choose(self, affinity=None):
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy and not b.ejected]
+            if not candidates:
+                return None
+            backend = min(candidates, key=Backend.load)
+            if affinity is not None:
+                # Rendezvous hashing keeps an image on the same backend, where
+                # the model may still have it preprocessed, while that
+                # backend has a free thread
+                preferred = max(
+                    candidates,
+                    key=lambda b: hashlib.sha256(f"{affinity}|{b.url}".encode()).digest(),
+                )
+                if preferred.outstanding < preferred.capacity:
+                    backend = preferred
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend, failed=False):
+        with self._lock:
+            backend.outstanding -= 1
+            if failed:
+                self._record_failure(backend)
+            else:
+                backend.failures = 0
+
+    def call(self, fn, affinity=None, on_backend=None):
+        self.start()
+        backend = self.choose(affinity)
+        if backend is None:
+            raise cog_client.PredictionError("No healthy Cog backend", status_code=503)
+        if on_backend is not None:
+            on_backend(backend.url)
+        failed = False
+        try:
+            return fn(backend.url)
+        except requests.exceptions.RequestException:
+            failed = True
+            raise
+        except cog_client.PredictionError as e:
+            failed = e.status_code is not None and e.status_code >= 500
+            raise
+        finally:
+            self.release(backend, failed)
+
+    async def call_async(self, fn, affinity=None, on_backend=None):
+        # fn is a coroutine function taking the backend URL
+        self.start()
+        backend = self.choose(affinity)
+        if backend is None:
+            raise cog_client.PredictionError("No healthy Cog backend", status_code=503)
+        if on_backend is not None:
+            on_backend(backend.url)
+        failed = False
+        try:
+            return await fn(backend.url)
+        except httpx.HTTPError:
+            failed = True
+            raise
+        except cog_client.PredictionError as e:
+            failed = e.status_code is not None and e.status_code >= 500
+            raise
+        finally:
+            self.release(backend, failed)
+
+    def probe(self, backend):
+        try:
+            response = cog_client.get(
+                f"{backend.url}/health-check",
+                timeout=(BACKEND_PROBE_TIMEOUT, BACKEND_PROBE_TIMEOUT),
+            )
+            status = response.json().get("status")
+        except (requests.exceptions.RequestException, ValueError):
+            status = None
+        with self._lock:
+            if status in ROUTABLE_STATUSES:
+                backend.healthy = True
+                backend.ejected = False
+                backend.failures = 0
+            elif status == "STARTING":
+                # Still loading the model, not a failure
+                backend.healthy = False
+            else:
+                backend.healthy = False
+                self._record_failure(backend)
+
+    def stats(self):
+        with self._lock:
+            stats = {"capacity": self.capacity}
+            for index, backend in enumerate(self.backends):
+                stats[f"{index}_outstanding"] = backend.outstanding
+                stats[f"{index}_healthy"] = int(backend.healthy and not backend.ejected)
+                stats[f"{index}_requests"] = backend.requests
+            return stats
+
+    def _record_failure(self, backend):
+        backend.failures += 1
+        if backend.failures >= self.failure_threshold:
+            # Stays out of rotation until a health probe succeeds
+            backend.ejected = True
+
+    def _probe_forever(self):
+        while True:
+            for backend in self.backends:
+                self.probe(backend)
+            time.sleep(self.probe_interval)
+
+
+_backend_pool = None
+_backend_pool_lock = threading.Lock()
+
+
+def get_backend_pool():
+    global _backend_pool
+    if _backend_pool is None:
+        with _backend_pool_lock:
+            if _backend_pool is None:
+                _backend_pool = BackendPool(COG_API_URLS)
+    return _backend_pool
@@ -0,0 +1,461 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, TimeoutError
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.metrics import NullTrace
+
+
+COG_API_URL = os.environ.get("COG_API_URL", "http://0.0.0.0:5000")
+# Matches the --threads=10 the Cog server is started with in run.sh
+COG_POOL_SIZE = int(os.environ.get("COG_POOL_SIZE", 10))
+COG_CONNECT_TIMEOUT = float(os.environ.get("COG_CONNECT_TIMEOUT", 5))
+COG_READ_TIMEOUT = float(os.environ.get("COG_READ_TIMEOUT", 300))
+COG_RETRIES = int(os.environ.get("COG_RETRIES", 3))
+COG_RETRY_BACKOFF = float(os.environ.get("COG_RETRY_BACKOFF", 0.2))
+# "wait" asks for a synchronous response with Prefer: wait, "webhook" has Cog
+# push the finished prediction to a local receiver and "poll" only polls
+COG_COMPLETION_MODE = os.environ.get("COG_COMPLETION_MODE", "wait")
+COG_PREDICTION_DEADLINE = float(os.environ.get("COG_PREDICTION_DEADLINE", 600))
+COG_POLL_INTERVAL_MIN = float(os.environ.get("COG_POLL_INTERVAL_MIN", 0.05))
+COG_POLL_INTERVAL_MAX = float(os.environ.get("COG_POLL_INTERVAL_MAX", 1.0))
+COG_POLL_BACKOFF = float(os.environ.get("COG_POLL_BACKOFF", 1.5))
+COG_WEBHOOK_HOST = os.environ.get("COG_WEBHOOK_HOST", "0.0.0.0")
+COG_WEBHOOK_PORT = int(os.environ.get("COG_WEBHOOK_PORT", 7861))
+COG_WEBHOOK_URL = os.environ.get(
+    "COG_WEBHOOK_URL", f"http://127.0.0.1:{COG_WEBHOOK_PORT}"
+)
+COG_WEBHOOK_FALLBACK_INTERVAL = float(
+    os.environ.get("COG_WEBHOOK_FALLBACK_INTERVAL", 5)
+)
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+RETRY_STATUSES = (502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+_async_client = None
+_async_client_loop = None
+
+
+def create_session(
+    pool_size=COG_POOL_SIZE, retries=COG_RETRIES, backoff_factor=COG_RETRY_BACKOFF
+):
+    # Connection errors are retried for every method because nothing reached
+    # the server; read and status retries are limited to idempotent polls so a
+    # submitted prediction is never started twice.
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def default_timeout():
+    return (COG_CONNECT_TIMEOUT, COG_READ_TIMEOUT)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", default_timeout())
+    return get_session().post(url, **kwargs)
+
+
+def get(url, **kwargs):
+    kwargs.setdefault("timeout", default_timeout())
+    return get_session().get(url, **kwargs)
+
+
+def create_async_client(pool_size=COG_POOL_SIZE, retries=COG_RETRIES):
+    # httpx only retries failed connects, which is what create_session allows
+    # for POSTs too; get_async adds the read and status retries for polls
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(retries=retries),
+        limits=httpx.Limits(max_keepalive_connections=pool_size),
+        timeout=httpx.Timeout(COG_READ_TIMEOUT, connect=COG_CONNECT_TIMEOUT),
+    )
+
+
+def get_async_client():
+    # An AsyncClient is tied to the event loop it was first used on
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = create_async_client()
+        _async_client_loop = loop
+    return _async_client
+
+
+async def post_async(url, **kwargs):
+    return await get_async_client().post(url, **kwargs)
+
+
+async def get_async(url, retries=COG_RETRIES, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            response = await get_async_client().get(url, **kwargs)
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                return response
+        await asyncio.sleep(COG_RETRY_BACKOFF * 2**attempt)
+        attempt += 1
+
+
+class PredictionError(Exception):
+    def __init__(self, message, status_code=None, prediction=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.prediction = prediction
+
+
+class WebhookReceiver:
+    def __init__(self, host=COG_WEBHOOK_HOST, port=COG_WEBHOOK_PORT):
+        self.host = host
+        self.port = port
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        with self._lock:
+            if self._server is not None:
+                return
+            receiver = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_POST(self):
+                    length = int(self.headers.get("Content-Length") or 0)
+                    body = self.rfile.read(length)
+                    self.send_response(200)
+                    self.end_headers()
+                    try:
+                        prediction = json.loads(body)
+                    except ValueError:
+                        return
+                    receiver.deliver(self.path.strip("/"), prediction)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def register(self):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._waiters[token] = Future()
+        return token, f"{COG_WEBHOOK_URL}/{token}"
+
+    def deliver(self, token, prediction):
+        # Intermediate events can arrive when the filter is ignored
+        if prediction.get("status") not in TERMINAL_STATUSES:
+            return
+        with self._lock:
+            waiter = self._waiters.get(token)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(prediction)
+
+    def wait(self, token, timeout):
+        with self._lock:
+            waiter = self._waiters[token]
+        try:
+            return waiter.result(timeout)
+        except TimeoutError:
+            return None
+
+    async def wait_async(self, token, timeout):
+        with self._lock:
+            waiter = self._waiters[token]
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(waiter)), timeout
+            )
+        except asyncio.TimeoutError:
+            return None
+
+    def unregister(self, token):
+        with self._lock:
+            self._waiters.pop(token, None)
+
+
+_webhook_receiver = None
+
+
+def get_webhook_receiver():
+    global _webhook_receiver
+    with _session_lock:
+        if _webhook_receiver is None:
+            _webhook_receiver = WebhookReceiver()
+    _webhook_receiver.start()
+    return _webhook_receiver
+
+
+def parse_prediction(response, trace=None):
+    trace = trace or NullTrace()
+    trace.count("response_bytes", len(response.content))
+    if response.status_code not in (200, 201, 202):
+        raise PredictionError(
+            f"{response.status_code}", status_code=response.status_code
+        )
+    with trace.stage("parse"):
+        return response.json()
+
+
+def check_prediction(prediction, trace=None):
+    if trace is not None:
+        record_cog_timings(prediction, trace)
+    if prediction.get("status") in ("failed", "canceled"):
+        raise PredictionError(
+            prediction.get("error") or f"Prediction {prediction['status']}",
+            prediction=prediction,
+        )
+    return prediction
+
+
+def record_cog_timings(prediction, trace):
+    # Time spent queued inside Cog versus running the model
+    try:
+        created_at = datetime.fromisoformat(prediction["created_at"])
+        started_at = datetime.fromisoformat(prediction["started_at"])
+        trace.record("cog_queue", (started_at - created_at).total_seconds())
+    except (KeyError, TypeError, ValueError):
+        pass
+    predict_time = (prediction.get("metrics") or {}).get("predict_time")
+    if predict_time is not None:
+        trace.record("cog_predict", predict_time)
+
+
+def encode_payload(payload, headers, trace):
+    body = json.dumps(payload)
+    trace.count("payload_bytes", len(body))
+    headers.setdefault("Content-Type", "application/json")
+    return body
+
+
+def submit_read_timeout(deadline_at):
+    # With Prefer: wait the POST lasts as long as the prediction, so it has
+    # to end by the overall deadline as well
+    if deadline_at is None:
+        return COG_READ_TIMEOUT
+    return max(min(deadline_at - time.monotonic(), COG_READ_TIMEOUT), 0.001)
+
+
+def submit_prediction(url, payload, headers, trace, deadline_at=None):
+    body = encode_payload(payload, headers, trace)
+    timeout = (COG_CONNECT_TIMEOUT, submit_read_timeout(deadline_at))
+    with trace.stage("post"):
+        response = post(url, headers=headers, data=body, timeout=timeout)
+    return parse_prediction(response, trace)
+
+
+async def submit_prediction_async(url, payload, headers, trace, deadline_at=None):
+    body = encode_payload(payload, headers, trace)
+    timeout = httpx.Timeout(
+        submit_read_timeout(deadline_at), connect=COG_CONNECT_TIMEOUT
+    )
+    with trace.stage("post"):
+        response = await post_async(
+            url, headers=headers, content=body, timeout=timeout
+        )
+    return parse_prediction(response, trace)
+
+
+def next_poll(prediction, deadline_at):
+    # Returns the URL to poll and how long may still be waited for it
+    follow_up_url = (prediction.get("urls") or {}).get("get")
+    if not follow_up_url:
+        raise PredictionError("Prediction cannot be polled", prediction=prediction)
+    remaining = deadline_at - time.monotonic()
+    if remaining <= 0:
+        raise PredictionError("Prediction timed out", prediction=prediction)
+    return follow_up_url, remaining
+
+
+def poll_prediction(prediction, headers=None, deadline_at=None, trace=None):
+    trace = trace or NullTrace()
+    if deadline_at is None:
+        deadline_at = time.monotonic() + COG_PREDICTION_DEADLINE
+    interval = COG_POLL_INTERVAL_MIN
+    while prediction.get("status") not in TERMINAL_STATUSES:
+        follow_up_url, remaining = next_poll(prediction, deadline_at)
+        with trace.stage("poll_wait"):
+            time.sleep(min(interval, remaining))
+        interval = min(interval * COG_POLL_BACKOFF, COG_POLL_INTERVAL_MAX)
+        trace.count("polls")
+        with trace.stage("poll"):
+            response = get(follow_up_url, headers=headers)
+        prediction = parse_prediction(response, trace)
+    return check_prediction(prediction, trace)
+
+
+async def poll_prediction_async(prediction, headers=None, deadline_at=None, trace=None):
+    trace = trace or NullTrace()
+    if deadline_at is None:
+        deadline_at = time.monotonic() + COG_PREDICTION_DEADLINE
+    interval = COG_POLL_INTERVAL_MIN
+    while prediction.get("status") not in TERMINAL_STATUSES:
+        follow_up_url, remaining = next_poll(prediction, deadline_at)
+        with trace.stage("poll_wait"):
+            await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * COG_POLL_BACKOFF, COG_POLL_INTERVAL_MAX)
+        trace.count("polls")
+        with trace.stage("poll"):
+            response = await get_async(follow_up_url, headers=headers)
+        prediction = parse_prediction(response, trace)
+    return check_prediction(prediction, trace)
+
+
+def run_prediction(url, payload, headers=None, mode=None, deadline=None, trace=None):
+    mode = mode or COG_COMPLETION_MODE
+    trace = trace or NullTrace()
+    headers = dict(headers or {})
+    deadline_at = time.monotonic() + (deadline or COG_PREDICTION_DEADLINE)
+    if mode == "webhook":
+        return _run_webhook_prediction(url, payload, headers, deadline_at, trace)
+    if mode == "wait":
+        headers["Prefer"] = "wait"
+    else:
+        # Without it a local Cog answers synchronously and nothing is polled
+        headers["Prefer"] = "respond-async"
+    prediction = submit_prediction(url, payload, headers, trace, deadline_at)
+    return poll_prediction(prediction, headers, deadline_at, trace)
+
+
+async def run_prediction_async(
+    url, payload, headers=None, mode=None, deadline=None, trace=None
+):
+    # Same as run_prediction, but waiting never holds a thread
+    mode = mode or COG_COMPLETION_MODE
+    trace = trace or NullTrace()
+    headers = dict(headers or {})
+    deadline_at = time.monotonic() + (deadline or COG_PREDICTION_DEADLINE)
+    if mode == "webhook":
+        return await _run_webhook_prediction_async(
+            url, payload, headers, deadline_at, trace
+        )
+    if mode == "wait":
+        headers["Prefer"] = "wait"
+    else:
+        # Without it a local Cog answers synchronously and nothing is polled
+        headers["Prefer"] = "respond-async"
+    prediction = await submit_prediction_async(
+        url, payload, headers, trace, deadline_at
+    )
+    return await poll_prediction_async(prediction, headers, deadline_at, trace)
+
+
+def _run_webhook_prediction(url, payload, headers, deadline_at, trace):
+    receiver = get_webhook_receiver()
+    token, webhook_url = receiver.register()
+    try:
+        payload = dict(payload, webhook=webhook_url, webhook_events_filter=["completed"])
+        headers["Prefer"] = "respond-async"
+        prediction = submit_prediction(url, payload, headers, trace, deadline_at)
+        while prediction.get("status") not in TERMINAL_STATUSES:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                raise PredictionError("Prediction timed out", prediction=prediction)
+            with trace.stage("webhook_wait"):
+                pushed = receiver.wait(
+                    token, min(remaining, COG_WEBHOOK_FALLBACK_INTERVAL)
+                )
+            if pushed is not None:
+                return check_prediction(pushed, trace)
+            # Fall back to a status poll in case the webhook was lost
+            follow_up_url = (prediction.get("urls") or {}).get("get")
+            if follow_up_url:
+                trace.count("polls")
+                with trace.stage("poll"):
+                    response = get(follow_up_url, headers=headers)
+                prediction = parse_prediction(response, trace)
+        return check_prediction(prediction, trace)
+    finally:
+        receiver.unregister(token)
+
+
+async def _run_webhook_prediction_async(url, payload, headers, deadline_at, trace):
+    receiver = get_webhook_receiver()
+    token, webhook_url = receiver.register()
+    try:
+        payload = dict(payload, webhook=webhook_url, webhook_events_filter=["completed"])
+        headers["Prefer"] = "respond-async"
+        prediction = await submit_prediction_async(
+            url, payload, headers, trace, deadline_at
+        )
+        while prediction.get("status") not in TERMINAL_STATUSES:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                raise PredictionError("Prediction timed out", prediction=prediction)
+            with trace.stage("webhook_wait"):
+                pushed = await receiver.wait_async(
+                    token, min(remaining, COG_WEBHOOK_FALLBACK_INTERVAL)
+                )
+            if pushed is not None:
+                return check_prediction(pushed, trace)
+            follow_up_url = (prediction.get("urls") or {}).get("get")
+            if follow_up_url:
+                trace.count("polls")
+                with trace.stage("poll"):
+                    response = await get_async(follow_up_url, headers=headers)
+                prediction = parse_prediction(response, trace)
+        return check_prediction(prediction, trace)
+    finally:
+        receiver.unregister(token)
+
+
+def cancel_prediction(api_url, prediction_id, headers=None):
+    # Best effort: the prediction may already have finished
+    try:
+        post(
+            f"{api_url.rstrip('/')}/{prediction_id}/cancel",
+            headers=headers,
+            timeout=(COG_CONNECT_TIMEOUT, COG_CONNECT_TIMEOUT),
+        )
+    except requests.exceptions.RequestException:
+        pass
+
+
+async def cancel_prediction_async(api_url, prediction_id, headers=None):
+    try:
+        await post_async(
+            f"{api_url.rstrip('/')}/{prediction_id}/cancel",
+            headers=headers,
+            timeout=COG_CONNECT_TIMEOUT,
+        )
+    except httpx.HTTPError:
+        pass
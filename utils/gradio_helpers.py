@@ -1,13 +1,33 @@
 import gradio as gr
 from urllib.parse import urlparse
+import asyncio
+import functools
+import httpx
 import requests
-import time
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-import base64
-import io
-import uuid
 import os
 
+from utils import cog_client
+from utils.admission import SUBMIT, AdmissionError, get_admission_controller
+from utils.backends import BackendPool
+from utils.input_handoff import file_reference
+from utils.metrics import NullTrace, start_trace
+from utils.output_store import get_output_store, sink_filename, sink_stored_name
+
+
+# Threads for decoding outputs and other CPU work off the event loop
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", 4))
+
+_decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _decode_executor, functools.partial(fn, *args, **kwargs)
+    )
+
 
 def extract_property_info(prop):
     combined_prop = {}
@@ -221,35 +241,37 @@ def build_gradio_outputs_cog():
     pass
 
 
-def process_outputs(outputs):
+def process_outputs(outputs, passthrough=False):
+    output_store = get_output_store()
     output_values = []
     for output in outputs:
         if not output:
             continue
         if isinstance(output, str):
             if output.startswith("data:image"):
-                base64_data = output.split(",", 1)[1]
-                image_data = base64.b64decode(base64_data)
-                image_stream = io.BytesIO(image_data)
-                image = Image.open(image_stream)
-                output_values.append(image)
+                # Keep the bytes exactly as the model encoded them
+                filename = output_store.write_data_uri(output, ".png")
+                if passthrough:
+                    output_values.append(filename)
+                else:
+                    # PIL reads the file lazily, only once pixels are needed
+                    output_values.append(Image.open(filename))
             elif output.startswith("data:audio"):
-                base64_data = output.split(",", 1)[1]
-                audio_data = base64.b64decode(base64_data)
-                audio_stream = io.BytesIO(audio_data)
-                filename = f"{uuid.uuid4()}.wav"  # Change format as needed
-                with open(filename, "wb") as audio_file:
-                    audio_file.write(audio_stream.getbuffer())
+                filename = output_store.write_data_uri(output, ".wav")
                 output_values.append(filename)
             elif output.startswith("data:video"):
-                base64_data = output.split(",", 1)[1]
-                video_data = base64.b64decode(base64_data)
-                video_stream = io.BytesIO(video_data)
-                # Here you can save the audio or return the stream for further processing
-                filename = f"{uuid.uuid4()}.mp4"  # Change format as needed
-                with open(filename, "wb") as video_file:
-                    video_file.write(video_stream.getbuffer())
+                filename = output_store.write_data_uri(output, ".mp4")
                 output_values.append(filename)
+            elif sink_filename(output):
+                # Cog uploaded the file to our sink, the JSON only names it
+                try:
+                    filename = resolve_sink_output(output)
+                except (OSError, requests.exceptions.RequestException) as e:
+                    raise gr.Error(f"The output file could not be fetched. ({e})")
+                if detect_file_type(filename) == "image" and not passthrough:
+                    output_values.append(Image.open(filename))
+                else:
+                    output_values.append(filename)
             else:
                 output_values.append(output)
         else:
@@ -257,28 +279,242 @@ def process_outputs(outputs):
     return output_values
 
 
-def parse_outputs(data):
-    if isinstance(data, dict):
-        # Handle case where data is an object
-        dict_values = []
-        for value in data.values():
-            extracted_values = parse_outputs(value)
-            # For dict, we append instead of extend to maintain list structure within objects
-            if isinstance(value, list):
-                dict_values += [extracted_values]
+def resolve_sink_output(output):
+    output_store = get_output_store()
+    filename = output_store.local_path(sink_filename(output))
+    if filename is not None:
+        # Cache hits and coalesced callers all resolve to the same upload
+        return output_store.private_copy(filename)
+    if not output.startswith(("http://", "https://")):
+        raise FileNotFoundError(f"Output {output} is no longer available")
+    # Uploaded to a frontend on another machine, e.g. when run from batch.py
+    response = cog_client.get(output, stream=True)
+    response.raise_for_status()
+    filename = output_store.new_path(os.path.splitext(output)[1])
+    with open(filename, "wb") as output_file:
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            output_file.write(chunk)
+    output_store.add(filename)
+    return filename
+
+
+def claim_sink_outputs(prediction):
+    # Cog versions that ignore the sink's Location header report upload URL
+    # + their own filename; point those at the copy kept for this prediction
+    prediction_id = prediction.get("id")
+    if prediction_id and prediction.get("output") is not None:
+        prediction["output"] = _claim_sink_output(prediction["output"], prediction_id)
+    return prediction
+
+
+def _claim_sink_output(output, prediction_id):
+    if isinstance(output, list):
+        return [_claim_sink_output(item, prediction_id) for item in output]
+    if isinstance(output, dict):
+        return {key: _claim_sink_output(value, prediction_id) for key, value in output.items()}
+    if not isinstance(output, str):
+        return output
+    filename = sink_filename(output)
+    output_store = get_output_store()
+    if filename is None or output_store.local_path(filename) is not None:
+        return output
+    stored_name = sink_stored_name(prediction_id, filename)
+    if output_store.local_path(stored_name) is None:
+        return output
+    return output[: output.rindex("/") + 1] + stored_name
+
+
+def outputs_available(data):
+    # False when a cached output names sink files the store has evicted
+    output_store = get_output_store()
+    for output in iter_outputs(data):
+        if isinstance(output, str) and sink_filename(output):
+            if output_store.local_path(sink_filename(output)) is None:
+                return False
+    return True
+
+
+_exhausted = object()
+
+
+def iter_outputs(data):
+    # Walks the output with an explicit stack and yields each value as soon as
+    # it is reached. Lists inside an object stay grouped as one nested list,
+    # every other level is flattened.
+    # Each frame is (items, sink, in_dict, collected, parent_sink); a frame
+    # with collected=True emits its sink list to parent_sink when exhausted.
+    stack = [(iter((data,)), None, False, False, None)]
+    while stack:
+        items, sink, in_dict, collected, parent_sink = stack[-1]
+        item = next(items, _exhausted)
+        if item is _exhausted:
+            stack.pop()
+            if collected:
+                if parent_sink is None:
+                    yield sink
+                else:
+                    parent_sink.append(sink)
+        elif isinstance(item, dict):
+            stack.append((iter(item.values()), sink, True, False, None))
+        elif isinstance(item, list):
+            if in_dict:
+                stack.append((iter(item), [], False, True, sink))
             else:
-                dict_values += extracted_values
-        return dict_values
-    elif isinstance(data, list):
-        # Handle case where data is an array
-        list_values = []
-        for item in data:
-            # Here we extend to flatten the list since we're already in an array context
-            list_values += parse_outputs(item)
-        return list_values
+                stack.append((iter(item), sink, False, False, None))
+        elif sink is None:
+            yield item
+        else:
+            sink.append(item)
+
+
+def parse_outputs(data):
+    return list(iter_outputs(data))
+
+
+def build_payload(names, args, base_url=None, api_id=None, handoff=None):
+    payload = {"input": {}}
+    if api_id:
+        payload["version"] = api_id
+    for i, key in enumerate(names):
+        value = args[i]
+        if value and (os.path.exists(str(value))):
+            value = file_reference(value, base_url, handoff)
+        if value is not None and value != "":
+            payload["input"][key] = value
+    return payload
+
+
+def describe_payload(payload):
+    # Inline data URIs are far too large to print
+    described = dict(payload, input={})
+    for key, value in payload["input"].items():
+        if isinstance(value, str) and value.startswith("data:"):
+            value = value[: value.find(",") + 1] + "..."
+        described["input"][key] = value
+    return described
+
+
+def request_prediction(
+    api_url,
+    payload,
+    headers,
+    trace=None,
+    on_position=None,
+    abandoned=None,
+    affinity=None,
+    on_backend=None,
+    session=None,
+    priority=SUBMIT,
+):
+    # api_url is either a predictions URL or a BackendPool to route through;
+    # session and priority decide this call's share of the admission slots
+    trace = trace or NullTrace()
+
+    def run(url):
+        return claim_sink_outputs(
+            cog_client.run_prediction(url, payload, headers=headers, trace=trace)
+        )
+
+    if isinstance(api_url, BackendPool):
+        backend_pool = api_url
+
+        def run_prediction():
+            return backend_pool.call(
+                lambda url: run(f"{url}/predictions"), affinity, on_backend
+            )
+
     else:
-        # Handle primitive data types directly
-        return [data]
+
+        def run_prediction():
+            return run(api_url)
+
+    try:
+        with trace.stage("admission"):
+            grant = get_admission_controller().acquire(
+                on_position, abandoned, session, priority
+            )
+    except AdmissionError as e:
+        trace.count("rejected")
+        raise gr.Error(f"Sorry, the Cog image is busy. Try again in a bit. ({e})")
+    try:
+        return get_admission_controller().run_admitted(
+            run_prediction, grant, abandoned
+        )
+    except (
+        AdmissionError,
+        cog_client.PredictionError,
+        requests.exceptions.RequestException,
+    ) as e:
+        raise submission_error(e, trace)
+
+
+async def request_prediction_async(
+    api_url,
+    payload,
+    headers,
+    trace=None,
+    on_position=None,
+    abandoned=None,
+    affinity=None,
+    on_backend=None,
+    session=None,
+    priority=SUBMIT,
+):
+    # Same as request_prediction, but waits for admission and Cog on the
+    # event loop instead of in a worker thread
+    trace = trace or NullTrace()
+
+    async def run(url):
+        return claim_sink_outputs(
+            await cog_client.run_prediction_async(
+                url, payload, headers=headers, trace=trace
+            )
+        )
+
+    if isinstance(api_url, BackendPool):
+        backend_pool = api_url
+
+        async def run_prediction():
+            return await backend_pool.call_async(
+                lambda url: run(f"{url}/predictions"), affinity, on_backend
+            )
+
+    else:
+
+        async def run_prediction():
+            return await run(api_url)
+
+    try:
+        with trace.stage("admission"):
+            grant = await get_admission_controller().acquire_async(
+                on_position, abandoned, session, priority
+            )
+    except AdmissionError as e:
+        trace.count("rejected")
+        raise gr.Error(f"Sorry, the Cog image is busy. Try again in a bit. ({e})")
+    try:
+        return await get_admission_controller().run_admitted_async(
+            run_prediction, grant, abandoned
+        )
+    except (AdmissionError, cog_client.PredictionError, httpx.HTTPError) as e:
+        raise submission_error(e, trace)
+
+
+def submission_error(e, trace):
+    if isinstance(e, AdmissionError):
+        return gr.Error(f"The submission was abandoned. ({e})")
+    if isinstance(e, cog_client.PredictionError):
+        if e.status_code == 409:
+            trace.count("conflicts")
+            return gr.Error(
+                "Sorry, the Cog image is still processing. Try again in a bit."
+            )
+        trace.count("errors")
+        if e.status_code is not None:
+            return gr.Error(f"The submission failed! Error: {e.status_code}")
+        return gr.Error(f"The submission failed! {e}")
+    trace.count("errors")
+    return gr.Error(f"The submission failed! Error: {e}")
 
 
 def create_dynamic_gradio_app(
@@ -294,65 +530,66 @@ def create_dynamic_gradio_app(
     hostname="0.0.0.0",
 ):
     expected_outputs = len(outputs)
-
-    def predict(request: gr.Request, *args, progress=gr.Progress(track_tqdm=True)):
-        payload = {"input": {}}
-        if api_id:
-            payload["version"] = api_id
+    if isinstance(api_url, (list, tuple)):
+        # Spread predictions over several Cog endpoints
+        api_url = BackendPool(
+            [
+                url[: -len("/predictions")] if url.endswith("/predictions") else url
+                for url in api_url
+            ]
+        )
+
+    async def run(request, args, trace):
         parsed_url = urlparse(str(request.url))
-        if local_base:
-            base_url = f"http://{hostname}:7860"
-        else:
-            base_url = parsed_url.scheme + "://" + parsed_url.netloc
-        for i, key in enumerate(names):
-            value = args[i]
-            if value and (os.path.exists(str(value))):
-                value = f"{base_url}/file=" + value
-            if value is not None and value != "":
-                payload["input"][key] = value
-        print(payload)
+        with trace.stage("payload"):
+            if local_base:
+                base_url = f"http://{hostname}:7860"
+                handoff = None
+            else:
+                # A remote API can't reach local files any other way
+                base_url = parsed_url.scheme + "://" + parsed_url.netloc
+                handoff = "url"
+            payload = await run_blocking(
+                build_payload, names, args, base_url, api_id, handoff
+            )
+        print(describe_payload(payload))
         headers = {"Content-Type": "application/json"}
         if replicate_token:
             headers["Authorization"] = f"Token {replicate_token}"
         print(headers)
-        response = requests.post(api_url, headers=headers, json=payload)
-        if response.status_code == 201:
-            follow_up_url = response.json()["urls"]["get"]
-            response = requests.get(follow_up_url, headers=headers)
-            while response.json()["status"] != "succeeded":
-                if response.json()["status"] == "failed":
-                    raise gr.Error("The submission failed!")
-                response = requests.get(follow_up_url, headers=headers)
-                time.sleep(1)
-                # TODO: Add a failing mechanism if the API gets stuck
-        if response.status_code == 200:
-            json_response = response.json()
-            # If the output component is JSON return the entire output response
-            if outputs[0].get_config()["name"] == "json":
-                return json_response["output"]
-            predict_outputs = parse_outputs(json_response["output"])
-            processed_outputs = process_outputs(predict_outputs)
-            difference_outputs = expected_outputs - len(processed_outputs)
-            # If less outputs than expected, hide the extra ones
-            if difference_outputs > 0:
-                extra_outputs = [gr.update(visible=False)] * difference_outputs
-                processed_outputs.extend(extra_outputs)
-            # If more outputs than expected, cap the outputs to the expected number if
-            elif difference_outputs < 0:
-                processed_outputs = processed_outputs[:difference_outputs]
-
-            return (
-                tuple(processed_outputs)
-                if len(processed_outputs) > 1
-                else processed_outputs[0]
-            )
+        json_response = await request_prediction_async(
+            api_url, payload, headers, trace
+        )
+        # If the output component is JSON return the entire output response
+        if outputs[0].get_config()["name"] == "json":
+            return json_response["output"]
+        with trace.stage("decode"):
+            predict_outputs = iter_outputs(json_response["output"])
+            processed_outputs = await run_blocking(process_outputs, predict_outputs)
+        difference_outputs = expected_outputs - len(processed_outputs)
+        # If less outputs than expected, hide the extra ones
+        if difference_outputs > 0:
+            extra_outputs = [gr.update(visible=False)] * difference_outputs
+            processed_outputs.extend(extra_outputs)
+        # If more outputs than expected, cap the outputs to the expected number if
+        elif difference_outputs < 0:
+            processed_outputs = processed_outputs[:difference_outputs]
 
-        else:
-            if response.status_code == 409:
-                raise gr.Error(
-                    f"Sorry, the Cog image is still processing. Try again in a bit."
-                )
-            raise gr.Error(f"The submission failed! Error: {response.status_code}")
+        return (
+            tuple(processed_outputs)
+            if len(processed_outputs) > 1
+            else processed_outputs[0]
+        )
+
+    async def predict(request: gr.Request, *args, progress=gr.Progress(track_tqdm=True)):
+        trace = start_trace("dynamic")
+        status = "error"
+        try:
+            result = await run(request, args, trace)
+            status = "ok"
+            return result
+        finally:
+            trace.finish(status)
 
     app = gr.Interface(
         fn=predict,
@@ -382,58 +619,35 @@ def create_gradio_app_script(
 
     if local_base:
         base_url = f'base_url = "http://{hostname}:7860"'
+        handoff = None
     else:
         base_url = """parsed_url = urlparse(str(request.url))
     base_url = parsed_url.scheme + "://" + parsed_url.netloc"""
+        handoff = "url"
     headers_string = f"""headers = {headers}\n"""
-    api_id_value = f'payload["version"] = "{api_id}"' if api_id is not None else ""
     definition_string = """expected_outputs = len(outputs)
-def predict(request: gr.Request, *args, progress=gr.Progress(track_tqdm=True)):"""
-    payload_string = f"""payload = {{"input": {{}}}}
-    {api_id_value}
+async def predict(request: gr.Request, *args, progress=gr.Progress(track_tqdm=True)):"""
+    payload_string = f"""{base_url}
+    payload = await run_blocking(build_payload, names, args, base_url, {api_id!r}, {handoff!r})\n"""
+
+    request_string = f"""json_response = await request_prediction_async("{api_url}", payload, headers)\n"""
+
+    result_string = """
+    #If the output component is JSON return the entire output response 
+    if(outputs[0].get_config()["name"] == "json"):
+        return json_response["output"]
+    predict_outputs = iter_outputs(json_response["output"])
+    processed_outputs = await run_blocking(process_outputs, predict_outputs)
+    difference_outputs = expected_outputs - len(processed_outputs)
+    # If less outputs than expected, hide the extra ones
+    if difference_outputs > 0:
+        extra_outputs = [gr.update(visible=False)] * difference_outputs
+        processed_outputs.extend(extra_outputs)
+    # If more outputs than expected, cap the outputs to the expected number
+    elif difference_outputs < 0:
+        processed_outputs = processed_outputs[:difference_outputs]
     
-    {base_url}
-    for i, key in enumerate(names):
-        value = args[i]
-        if value and (os.path.exists(str(value))):
-            value = f"{{base_url}}/file=" + value
-        if value is not None and value != "":
-            payload["input"][key] = value\n"""
-
-    request_string = (
-        f"""response = requests.post("{api_url}", headers=headers, json=payload)\n"""
-    )
-
-    result_string = f"""
-    if response.status_code == 201:
-        follow_up_url = response.json()["urls"]["get"]
-        response = requests.get(follow_up_url, headers=headers)
-        while response.json()["status"] != "succeeded":
-            if response.json()["status"] == "failed":
-                raise gr.Error("The submission failed!")
-            response = requests.get(follow_up_url, headers=headers)
-            time.sleep(1)
-    if response.status_code == 200:
-        json_response = response.json()
-        #If the output component is JSON return the entire output response 
-        if(outputs[0].get_config()["name"] == "json"):
-            return json_response["output"]
-        predict_outputs = parse_outputs(json_response["output"])
-        processed_outputs = process_outputs(predict_outputs)
-        difference_outputs = expected_outputs - len(processed_outputs)
-        # If less outputs than expected, hide the extra ones
-        if difference_outputs > 0:
-            extra_outputs = [gr.update(visible=False)] * difference_outputs
-            processed_outputs.extend(extra_outputs)
-        # If more outputs than expected, cap the outputs to the expected number
-        elif difference_outputs < 0:
-            processed_outputs = processed_outputs[:difference_outputs]
-        
-        return tuple(processed_outputs) if len(processed_outputs) > 1 else processed_outputs[0]
-    else:
-        if(response.status_code == 409):
-            raise gr.Error(f"Sorry, the Cog image is still processing. Try again in a bit.")
-        raise gr.Error(f"The submission failed! Error: {{response.status_code}}")\n"""
+    return tuple(processed_outputs) if len(processed_outputs) > 1 else processed_outputs[0]\n"""
 
     interface_string = f"""title = "{title}"
 model_description = "{model_description}"
@@ -451,11 +665,8 @@ app.launch(share=True)
 
     app_string = f"""import gradio as gr
 from urllib.parse import urlparse
-import requests
-import time
-import os
 
-from utils.gradio_helpers import parse_outputs, process_outputs
+from utils.gradio_helpers import build_payload, iter_outputs, process_outputs, request_prediction_async, run_blocking
 
 {inputs_string}
 {outputs_string}
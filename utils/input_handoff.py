@@ -0,0 +1,56 @@
+import base64
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+from utils.input_normalize import normalized_input
+from utils.result_cache import hash_file
+
+
+# "data_uri" embeds the file in the prediction request, "url" makes Cog fetch
+# it back from Gradio's /file= route
+INPUT_HANDOFF = os.environ.get("INPUT_HANDOFF", "data_uri")
+INPUT_DATA_URI_CACHE_BYTES = int(
+    os.environ.get("INPUT_DATA_URI_CACHE_BYTES", 128 * 1024 * 1024)
+)
+
+_data_uris = OrderedDict()
+_data_uris_bytes = 0
+_data_uris_lock = threading.Lock()
+
+
+def build_data_uri(path):
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    with open(path, "rb") as f:
+        encoded = base64.b64encode(f.read()).decode("ascii")
+    return f"data:{mime_type};base64,{encoded}"
+
+
+def get_data_uri(path):
+    global _data_uris_bytes
+    # Keyed by content so re-uploads of the same image share one encoding
+    key = hash_file(path)
+    with _data_uris_lock:
+        data_uri = _data_uris.get(key)
+        if data_uri is not None:
+            _data_uris.move_to_end(key)
+            return data_uri
+    data_uri = build_data_uri(path)
+    with _data_uris_lock:
+        if key not in _data_uris:
+            _data_uris[key] = data_uri
+            _data_uris_bytes += len(data_uri)
+        while _data_uris_bytes > INPUT_DATA_URI_CACHE_BYTES and len(_data_uris) > 1:
+            _, evicted = _data_uris.popitem(last=False)
+            _data_uris_bytes -= len(evicted)
+    return data_uri
+
+
+def file_reference(path, base_url=None, handoff=None):
+    handoff = handoff or INPUT_HANDOFF
+    if handoff == "url" and base_url:
+        # /file= only serves Gradio's own uploads, not INPUT_NORMALIZED_DIR
+        return f"{base_url}/file=" + path
+    # Send the upright, downscaled copy rather than the original upload
+    return get_data_uri(normalized_input(path))
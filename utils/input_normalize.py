@@ -0,0 +1,97 @@
+import mimetypes
+import os
+import tempfile
+import threading
+
+from PIL import Image, ImageOps
+
+from utils.output_store import OutputStore
+from utils.result_cache import hash_file
+
+
+INPUT_NORMALIZE = os.environ.get("INPUT_NORMALIZE", "1") == "1"
+# Large enough that a crop_factor 2.5 face crop still has more pixels than
+# the model's 512px working resolution on typical portraits
+INPUT_MAX_SIDE = int(os.environ.get("INPUT_MAX_SIDE", 2048))
+INPUT_JPEG_QUALITY = int(os.environ.get("INPUT_JPEG_QUALITY", 92))
+# Smaller, upright images are passed through untouched
+INPUT_REENCODE_BYTES = int(os.environ.get("INPUT_REENCODE_BYTES", 1024 * 1024))
+INPUT_NORMALIZED_DIR = os.environ.get(
+    "INPUT_NORMALIZED_DIR",
+    os.path.join(tempfile.gettempdir(), "expression-editor", "inputs"),
+)
+EXIF_ORIENTATION = 0x0112
+
+_normalized = {}
+_normalized_lock = threading.Lock()
+_normalized_store = None
+
+
+def get_normalized_store():
+    global _normalized_store
+    with _normalized_lock:
+        if _normalized_store is None:
+            _normalized_store = OutputStore(directory=INPUT_NORMALIZED_DIR)
+    return _normalized_store
+
+
+def is_image(path):
+    mime_type = mimetypes.guess_type(path)[0] or ""
+    return mime_type.startswith("image/")
+
+
+def needs_normalizing(image, path, max_side):
+    if max(image.size) > max_side:
+        return True
+    if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        return True
+    return os.path.getsize(path) > INPUT_REENCODE_BYTES
+
+
+def normalize_image(path, max_side=INPUT_MAX_SIDE, quality=INPUT_JPEG_QUALITY):
+    # Returns a path to an upright image no larger than max_side, stored by
+    # content hash so every render of the same upload shares one file
+    digest = hash_file(path)
+    with _normalized_lock:
+        normalized = _normalized.get(digest)
+    if normalized is not None and os.path.exists(normalized):
+        return normalized
+    with Image.open(path) as image:
+        if not needs_normalizing(image, path, max_side):
+            normalized = path
+        else:
+            has_alpha = image.mode in ("RGBA", "LA") or (
+                image.mode == "P" and "transparency" in image.info
+            )
+            extension = ".png" if has_alpha else ".jpg"
+            normalized = os.path.join(get_normalized_store().directory, digest + extension)
+            if not os.path.exists(normalized):
+                write_normalized(image, normalized, has_alpha, max_side, quality)
+    with _normalized_lock:
+        if len(_normalized) > 4096:
+            _normalized.clear()
+        _normalized[digest] = normalized
+    return normalized
+
+
+def write_normalized(image, normalized, has_alpha, max_side, quality):
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    tmp_path = f"{normalized}.{threading.get_ident()}.tmp"
+    if has_alpha:
+        image.save(tmp_path, format="PNG", optimize=True)
+    else:
+        image.convert("RGB").save(tmp_path, format="JPEG", quality=quality, optimize=True)
+    os.replace(tmp_path, normalized)
+    get_normalized_store().add(normalized)
+
+
+def normalized_input(path):
+    # The file the handoff layer should send in place of path
+    if not INPUT_NORMALIZE or not is_image(path):
+        return path
+    try:
+        return normalize_image(path)
+    except (OSError, ValueError):
+        # Not something PIL can read, let the model decide
+        return path
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+REQUEST_LOG = os.environ.get("REQUEST_LOG", "0") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7)
+
+logger = logging.getLogger("expression_editor.requests")
+if REQUEST_LOG:
+    # Nothing else configures this logger, and the root logger drops INFO
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_gauges(self, prefix, collect, help_text=""):
+        # collect() returns {name: value} and is called at scrape time
+        self._gauges[prefix] = collect
+        self._help[prefix] = help_text
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, list(h.counts), h.total, h.count, h.buckets)
+                for key, h in self._histograms.items()
+            )
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), counts, total, count, buckets in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = labels + (("le", str(bound)),)
+                lines.append(f"{name}_bucket{format_labels(le)} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for prefix, collect in list(self._gauges.items()):
+            for key, value in collect().items():
+                if self._help.get(prefix):
+                    lines.append(f"# HELP {prefix}_{key} {self._help[prefix]}")
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = Registry()
+
+
+class RequestTrace:
+    def __init__(self, path):
+        self.path = path
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self, status):
+        total = time.perf_counter() - self.started
+        if METRICS_ENABLED:
+            self._publish(status, total)
+        if REQUEST_LOG:
+            logger.info(
+                json.dumps(
+                    {
+                        "path": self.path,
+                        "status": status,
+                        "duration": round(total, 6),
+                        "stages": {k: round(v, 6) for k, v in self.stages.items()},
+                        "counts": self.counts,
+                    }
+                )
+            )
+
+    def _publish(self, status, total):
+        registry.inc("predict_requests_total", path=self.path, status=status)
+        registry.observe("predict_duration_seconds", total, path=self.path)
+        for name, seconds in self.stages.items():
+            registry.observe(
+                "predict_stage_duration_seconds", seconds, path=self.path, stage=name
+            )
+        for name, value in self.counts.items():
+            if name.endswith("_bytes"):
+                registry.observe(
+                    f"predict_{name}", value, buckets=SIZE_BUCKETS, path=self.path
+                )
+            else:
+                registry.inc(f"predict_{name}_total", value, path=self.path)
+
+
+class NullTrace:
+    def stage(self, name):
+        return nullcontext()
+
+    def record(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def finish(self, status):
+        pass
+
+
+_null_trace = NullTrace()
+
+
+def start_trace(path):
+    if not METRICS_ENABLED and not REQUEST_LOG:
+        return _null_trace
+    return RequestTrace(path)
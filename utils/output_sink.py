@@ -0,0 +1,60 @@
+import os
+import shutil
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+
+from utils.output_store import (
+    OUTPUT_SINK_PATH,
+    get_output_store,
+    sink_extension,
+    sink_stored_name,
+)
+
+
+# Cog runs next to the frontend; anyone else must not be able to fill the disk
+OUTPUT_SINK_ALLOWED_HOSTS = [
+    host.strip()
+    for host in os.environ.get("OUTPUT_SINK_ALLOWED_HOSTS", "127.0.0.1,::1").split(",")
+    if host.strip()
+]
+
+
+async def receive_output(filename: str, request: Request):
+    if request.client is None or request.client.host not in OUTPUT_SINK_ALLOWED_HOSTS:
+        return Response(status_code=403)
+    output_store = get_output_store()
+    prediction_id = request.headers.get("x-prediction-id")
+    if prediction_id:
+        # Cog versions that ignore Location report upload URL + filename;
+        # the frontend maps that back to this name with its prediction id
+        path = os.path.join(output_store.directory, sink_stored_name(prediction_id, filename))
+        output_store.discard(path)
+    else:
+        path = output_store.new_path(sink_extension(filename))
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        # Older Cog versions send the file as a form field
+        form = await request.form()
+        with open(path, "wb") as f:
+            shutil.copyfileobj(form["file"].file, f)
+    else:
+        with open(path, "wb") as f:
+            async for chunk in request.stream():
+                f.write(chunk)
+    output_store.add(path)
+    # Cog puts this URL into the prediction output instead of the file
+    location = f"{str(request.base_url).rstrip('/')}{OUTPUT_SINK_PATH}/{os.path.basename(path)}"
+    return Response(status_code=201, headers={"Location": location})
+
+
+def serve_output(filename: str):
+    # Lets a process on another machine fetch an output it got a reference to
+    path = get_output_store().local_path(os.path.basename(filename))
+    if path is None:
+        return Response(status_code=404)
+    return FileResponse(path)
+
+
+def add_output_sink_routes(app):
+    app.add_api_route(f"{OUTPUT_SINK_PATH}/{{filename}}", receive_output, methods=["PUT"])
+    app.add_api_route(f"{OUTPUT_SINK_PATH}/{{filename}}", serve_output, methods=["GET"])
@@ -0,0 +1,193 @@
+import base64
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+
+OUTPUT_DIR = os.environ.get(
+    "OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "expression-editor", "outputs")
+)
+OUTPUT_DIR_MAX_BYTES = int(os.environ.get("OUTPUT_DIR_MAX_BYTES", 1024 * 1024 * 1024))
+OUTPUT_DIR_MAX_AGE = float(os.environ.get("OUTPUT_DIR_MAX_AGE", 3600))
+# Must stay a multiple of 4 so every chunk decodes on its own
+BASE64_CHUNK_SIZE = 4 * 64 * 1024
+# Route on the frontend that Cog PUTs output files to (cog --upload-url)
+OUTPUT_SINK_PATH = "/cog-upload"
+MAX_EXTENSION_LENGTH = 8
+UNSAFE_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def data_uri_extension(output, default=".bin"):
+    header = output[: output.find(",")]
+    mime_type = header[len("data:") :].split(";", 1)[0]
+    return mimetypes.guess_extension(mime_type) or default
+
+
+def sink_filename(output):
+    # Returns the stored file name when output is a URL from the output sink
+    if not output.startswith(("http://", "https://", OUTPUT_SINK_PATH)):
+        return None
+    path = urlparse(output).path
+    if not path.startswith(OUTPUT_SINK_PATH + "/"):
+        return None
+    filename = path[len(OUTPUT_SINK_PATH) + 1 :]
+    if not filename or "/" in filename or filename.startswith("."):
+        return None
+    return filename
+
+
+def sink_extension(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if len(extension) > MAX_EXTENSION_LENGTH or not extension[1:].isalnum():
+        return ".bin"
+    return extension
+
+
+def sink_stored_name(prediction_id, filename):
+    # Where the sink keeps a prediction's upload, so the name Cog made up
+    # can be found again from the prediction id
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    stem = UNSAFE_NAME_CHARACTERS.sub("_", stem).lstrip(".") or "output"
+    prefix = UNSAFE_NAME_CHARACTERS.sub("_", prediction_id)
+    return f"{prefix}-{stem}{sink_extension(filename)}"
+
+
+class OutputStore:
+    def __init__(
+        self, directory=OUTPUT_DIR, max_bytes=OUTPUT_DIR_MAX_BYTES, max_age=OUTPUT_DIR_MAX_AGE
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._files = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.files_written = 0
+        self.bytes_written = 0
+        self.files_evicted = 0
+        self.bytes_evicted = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._adopt_existing()
+
+    def new_path(self, extension):
+        return os.path.join(self.directory, f"{uuid.uuid4()}{extension}")
+
+    def write_data_uri(self, output, default_extension=".bin"):
+        filename = self.new_path(data_uri_extension(output, default_extension))
+        start = output.find(",") + 1
+        with open(filename, "wb") as output_file:
+            # Decode slice by slice so a large payload is never copied whole
+            for offset in range(start, len(output), BASE64_CHUNK_SIZE):
+                chunk = output[offset : offset + BASE64_CHUNK_SIZE]
+                output_file.write(base64.b64decode(chunk))
+        self.add(filename)
+        return filename
+
+    def local_path(self, filename):
+        # None once the file has been evicted
+        path = os.path.join(self.directory, filename)
+        return path if os.path.exists(path) else None
+
+    def private_copy(self, filename):
+        # A file of the caller's own, so discarding it can't pull a stored
+        # file out from under the result cache or another caller
+        copy = self.new_path(os.path.splitext(filename)[1])
+        try:
+            os.link(filename, copy)
+        except OSError:
+            shutil.copyfile(filename, copy)
+        self.add(copy)
+        return copy
+
+    def write_bytes(self, data, extension):
+        filename = self.new_path(extension)
+        with open(filename, "wb") as output_file:
+            output_file.write(data)
+        self.add(filename)
+        return filename
+
+    def add(self, filename):
+        size = os.path.getsize(filename)
+        with self._lock:
+            self._files[filename] = (time.time(), size)
+            self._bytes += size
+            self.files_written += 1
+            self.bytes_written += size
+        self.evict()
+
+    def discard(self, filename):
+        with self._lock:
+            entry = self._files.pop(filename, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def evict(self):
+        now = time.time()
+        expired = []
+        with self._lock:
+            while self._files:
+                filename, (created, size) = next(iter(self._files.items()))
+                if self._bytes <= self.max_bytes and now - created <= self.max_age:
+                    break
+                del self._files[filename]
+                self._bytes -= size
+                self.files_evicted += 1
+                self.bytes_evicted += size
+                expired.append(filename)
+        for filename in expired:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self._bytes,
+                "files_written": self.files_written,
+                "bytes_written": self.bytes_written,
+                "files_evicted": self.files_evicted,
+                "bytes_evicted": self.bytes_evicted,
+            }
+
+    def _adopt_existing(self):
+        # Files left over from a previous run count against the limits too
+        existing = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.is_file():
+                existing.append((stat.st_mtime, stat.st_size, entry.path))
+        existing.sort()
+        with self._lock:
+            for created, size, filename in existing:
+                self._files[filename] = (created, size)
+                self._bytes += size
+        self.evict()
+
+
+_output_store = None
+_output_store_lock = threading.Lock()
+
+
+def get_output_store():
+    global _output_store
+    if _output_store is None:
+        with _output_store_lock:
+            if _output_store is None:
+                _output_store = OutputStore()
+    return _output_store
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import cog_client
+
+
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 2))
+# Each session may prefetch PREFETCH_BUDGET renders per PREFETCH_BUDGET_WINDOW
+PREFETCH_BUDGET = int(os.environ.get("PREFETCH_BUDGET", 12))
+PREFETCH_BUDGET_WINDOW = float(os.environ.get("PREFETCH_BUDGET_WINDOW", 60))
+PREFETCH_NEIGHBOURS = int(os.environ.get("PREFETCH_NEIGHBOURS", 2))
+# Free Cog threads to leave untouched for real users
+PREFETCH_HEADROOM = int(os.environ.get("PREFETCH_HEADROOM", 1))
+MAX_TRACKED_SESSIONS = 1024
+
+
+def plan_neighbours(previous, current, names, bounds, count=PREFETCH_NEIGHBOURS):
+    # Finds the slider that changed since the session's last render and
+    # returns argument lists for the next values in the same step size,
+    # continuing in the direction of the change first
+    for key, (minimum, maximum) in bounds.items():
+        index = names.index(key)
+        before, after = previous[index], current[index]
+        if before is None or after is None or before == after:
+            continue
+        delta = after - before
+        candidates = []
+        for multiple in (1, -2, 2, -3):
+            value = round(after + delta * multiple, 4)
+            if minimum <= value <= maximum and value != before:
+                candidates.append(value)
+        neighbours = []
+        for value in candidates[:count]:
+            args = list(current)
+            args[index] = value
+            neighbours.append(args)
+        return neighbours
+    return []
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        run,
+        is_idle,
+        workers=PREFETCH_WORKERS,
+        budget=PREFETCH_BUDGET,
+        budget_window=PREFETCH_BUDGET_WINDOW,
+    ):
+        # run(args, prediction_id, on_backend) renders args into the cache
+        self.run = run
+        self.is_idle = is_idle
+        self.budget = budget
+        self.budget_window = budget_window
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._last_args = OrderedDict()
+        self._budgets = {}
+        self._running = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.skipped = 0
+        self.completed = 0
+        self.preempted = 0
+
+    def observe(self, session_id, args, names, bounds):
+        with self._lock:
+            previous = self._last_args.pop(session_id, None)
+            self._last_args[session_id] = list(args)
+            while len(self._last_args) > MAX_TRACKED_SESSIONS:
+                self._last_args.popitem(last=False)
+        if previous is None:
+            return
+        for neighbour in plan_neighbours(previous, args, names, bounds):
+            if not self._take_budget(session_id):
+                break
+            with self._lock:
+                self.submitted += 1
+            self._executor.submit(self._prefetch, neighbour)
+
+    def preempt(self, keep=None):
+        # Cancel running prefetches so a real request can have their threads,
+        # except one rendering keep since that request is waiting on it
+        with self._lock:
+            running = [
+                (prediction_id, backend_urls)
+                for prediction_id, (args, backend_urls) in self._running.items()
+                if args != keep
+            ]
+            self.preempted += len(running)
+        for prediction_id, backend_urls in running:
+            for url in backend_urls:
+                cog_client.cancel_prediction(f"{url}/predictions", prediction_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "skipped": self.skipped,
+                "completed": self.completed,
+                "preempted": self.preempted,
+                "running": len(self._running),
+            }
+
+    def _take_budget(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            started, used = self._budgets.get(session_id, (now, 0))
+            if now - started > self.budget_window:
+                started, used = now, 0
+            if used >= self.budget:
+                return False
+            self._budgets[session_id] = (started, used + 1)
+            if len(self._budgets) > MAX_TRACKED_SESSIONS:
+                self._budgets.pop(next(iter(self._budgets)))
+            return True
+
+    def _prefetch(self, args):
+        # Queued work goes stale quickly, only start it if Cog is still idle
+        if not self.is_idle():
+            with self._lock:
+                self.skipped += 1
+            return
+        prediction_id = uuid.uuid4().hex
+        backend_urls = []
+        with self._lock:
+            self._running[prediction_id] = (args, backend_urls)
+        try:
+            self.run(args, prediction_id, backend_urls.append)
+            with self._lock:
+                self.completed += 1
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._running.pop(prediction_id, None)
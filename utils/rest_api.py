@@ -0,0 +1,159 @@
+import asyncio
+import io
+import json
+import mimetypes
+import os
+import shutil
+import uuid
+import zipfile
+
+import gradio as gr
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, JSONResponse
+
+from utils.admission import BULK, SUBMIT, AdmissionError
+from utils.gradio_helpers import run_blocking
+from utils.output_store import get_output_store
+
+
+REST_MAX_IMAGES = int(os.environ.get("REST_MAX_IMAGES", 16))
+REST_MAX_UPLOAD_BYTES = int(os.environ.get("REST_MAX_UPLOAD_BYTES", 32 * 1024 * 1024))
+# Clients that send this share one fair-share session across requests
+REST_SESSION_HEADER = os.environ.get("REST_SESSION_HEADER", "X-Client-ID")
+MAX_SESSION_ID_LENGTH = 128
+
+
+class RestError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def coerce_value(key, raw, default):
+    # Form fields are strings; numbers follow the type of the UI default
+    if isinstance(default, bool):
+        return raw.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, (int, float)):
+        try:
+            value = float(raw)
+        except ValueError:
+            raise RestError(f"{key} must be a number, got {raw!r}")
+        return int(value) if isinstance(default, int) and value.is_integer() else value
+    return raw
+
+
+def parse_params(form, names, defaults):
+    unknown = sorted(set(form.keys()) - set(names))
+    if unknown:
+        raise RestError(f"Unknown parameters: {unknown}")
+    args = list(defaults)
+    for index, key in enumerate(names):
+        if key == "image" or key not in form:
+            continue
+        args[index] = coerce_value(key, form[key], defaults[index])
+    return args
+
+
+def save_upload(upload):
+    # Uploads are spooled by Starlette; the handoff layer needs a real path
+    extension = os.path.splitext(upload.filename or "")[1].lower() or ".png"
+    output_store = get_output_store()
+    path = output_store.new_path(extension)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(upload.file, f)
+    output_store.add(path)
+    return path
+
+
+def client_session(request):
+    # Behind the Space's proxy every client has the same address, so without
+    # the header each request is a session of its own
+    client_id = request.headers.get(REST_SESSION_HEADER, "").strip()
+    if client_id:
+        return f"rest:{client_id[:MAX_SESSION_ID_LENGTH]}"
+    return f"rest:{uuid.uuid4().hex}"
+
+
+def error_status(e):
+    if isinstance(e, RestError):
+        return e.status_code
+    if isinstance(e, gr.Error) and isinstance(e.__context__, AdmissionError):
+        return 503
+    return 502
+
+
+def error_response(e):
+    return JSONResponse({"error": str(e)}, status_code=error_status(e))
+
+
+def zip_results(filenames, results):
+    buffer = io.BytesIO()
+    errors = {}
+    # Encoded images don't compress any further
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for index, (filename, result) in enumerate(zip(filenames, results)):
+            stem = f"{index:03d}-{os.path.splitext(os.path.basename(filename))[0]}"
+            if isinstance(result, Exception):
+                errors[stem] = str(result)
+            else:
+                archive.write(result, stem + os.path.splitext(result)[1])
+        if errors:
+            archive.writestr("errors.json", json.dumps(errors, indent=2))
+    return buffer.getvalue()
+
+
+def make_render_endpoint(names, defaults, render):
+    # render(args, session, priority) is a coroutine returning the path of
+    # the encoded output.
+    # Send one or more "image" files plus any of the names as form fields;
+    # one image returns its bytes, several return a zip in upload order
+    async def render_endpoint(request: Request):
+        content_length = int(request.headers.get("content-length") or 0)
+        if content_length > REST_MAX_UPLOAD_BYTES:
+            return JSONResponse({"error": "Request too large"}, status_code=413)
+        form = await request.form()
+        uploads = form.getlist("image")
+        params = {key: value for key, value in form.items() if key != "image"}
+        paths = []
+        try:
+            if not uploads or isinstance(uploads[0], str):
+                raise RestError("Send at least one file in the image field")
+            if len(uploads) > REST_MAX_IMAGES:
+                raise RestError(f"At most {REST_MAX_IMAGES} images per request")
+            args = parse_params(params, names, defaults)
+            for upload in uploads:
+                paths.append(await run_blocking(save_upload, upload))
+            image_index = names.index("image")
+            # A multi-image request is bulk work that shouldn't starve single
+            # renders
+            session = client_session(request)
+            priority = BULK if len(paths) > 1 else SUBMIT
+            jobs = []
+            for path in paths:
+                image_args = list(args)
+                image_args[image_index] = path
+                jobs.append(render(image_args, session, priority))
+            # Admission control spreads these over the free Cog threads
+            results = await asyncio.gather(*jobs, return_exceptions=True)
+        except (RestError, gr.Error) as e:
+            return error_response(e)
+        finally:
+            await form.close()
+            # Cache keys and encodings are by content, the copies can go
+            for path in paths:
+                get_output_store().discard(path)
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, gr.Error):
+                raise result
+        if len(results) == 1:
+            if isinstance(results[0], Exception):
+                return error_response(results[0])
+            media_type = mimetypes.guess_type(results[0])[0] or "application/octet-stream"
+            return FileResponse(results[0], media_type=media_type)
+        if all(isinstance(result, Exception) for result in results):
+            return error_response(results[0])
+        filenames = [upload.filename or "image" for upload in uploads]
+        content = await run_blocking(zip_results, filenames, results)
+        return Response(content, media_type="application/zip")
+
+    return render_endpoint
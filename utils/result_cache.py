@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 256 * 1024 * 1024))
+RESULT_CACHE_MAX_AGE = float(os.environ.get("RESULT_CACHE_MAX_AGE", 3600))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR")
+RESULT_CACHE_DISK_BYTES = int(
+    os.environ.get("RESULT_CACHE_DISK_BYTES", 1024 * 1024 * 1024)
+)
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    # Slider events resend the same upload path, so remember digests by stat
+    stat = os.stat(path)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        cached = _file_hashes.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    hexdigest = digest.hexdigest()
+    with _file_hashes_lock:
+        if len(_file_hashes) > 4096:
+            _file_hashes.clear()
+        _file_hashes[path] = (stamp, hexdigest)
+    return hexdigest
+
+
+def normalize_value(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        # Sliders report 0.30000000000000004 and 0.3 for the same position
+        value = round(float(value), 6)
+        return 0.0 if value == 0 else value
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def make_cache_key(names, args):
+    parts = []
+    for i, key in enumerate(names):
+        value = args[i]
+        if value is None or value == "":
+            continue
+        if isinstance(value, str) and os.path.exists(value):
+            value = "sha256:" + hash_file(value)
+        parts.append([key, normalize_value(value)])
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(
+        self,
+        max_entries=RESULT_CACHE_SIZE,
+        max_bytes=RESULT_CACHE_BYTES,
+        max_age=RESULT_CACHE_MAX_AGE,
+        disk_dir=RESULT_CACHE_DIR,
+        disk_max_bytes=RESULT_CACHE_DISK_BYTES,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, size, output = entry
+                if now - stored_at <= self.max_age:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return output
+                self._drop(key)
+        output = self._disk_get(key, now)
+        with self._lock:
+            if output is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._memory_put(key, output, json.dumps(output))
+        return output
+
+    def contains(self, key):
+        # Doesn't touch the LRU order or the hit/miss counters
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.max_age:
+                return True
+        return bool(self.disk_dir) and os.path.exists(self._disk_path(key))
+
+    def put(self, key, output):
+        encoded = json.dumps(output)
+        self._memory_put(key, output, encoded)
+        self._disk_put(key, encoded)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _memory_put(self, key, output, encoded):
+        size = len(encoded)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.time(), size, output)
+            self._bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+            ):
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if now - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                return None
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key, encoded):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(encoded)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self._disk_evict()
+
+    def _disk_evict(self):
+        files = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.disk_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                self._disk_remove(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            self._disk_remove(path)
+            total -= size
+
+    def _disk_remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self.evictions += 1
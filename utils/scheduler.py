@@ -0,0 +1,92 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+
+
+SCHEDULER_DEBOUNCE = float(os.environ.get("SCHEDULER_DEBOUNCE", 0.15))
+
+
+class Ticket:
+    def __init__(self, session_id, generation):
+        self.session_id = session_id
+        self.generation = generation
+        # One per prediction started under this ticket, e.g. preview and final
+        self.cancels = []
+
+
+class LatestWinsScheduler:
+    # Tracks the newest render per session; older renders are cancelled on
+    # Cog and their results are dropped instead of being shown
+    def __init__(self, debounce=SCHEDULER_DEBOUNCE):
+        self.debounce = debounce
+        self._sessions = {}
+        # Shared by all sessions, so a session's state can be dropped once
+        # idle without a later ticket reusing an old generation
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+        self.superseded = 0
+        self.cancelled = 0
+
+    def begin(self, session_id):
+        with self._lock:
+            state = self._sessions.setdefault(
+                session_id, {"generation": 0, "active": []}
+            )
+            state["generation"] = next(self._generations)
+            ticket = Ticket(session_id, state["generation"])
+            stale = [t for t in state["active"] if t.cancels]
+            self.superseded += len(state["active"])
+            state["active"].append(ticket)
+        for old in stale:
+            self._cancel(old)
+        return ticket
+
+    def is_current(self, ticket):
+        with self._lock:
+            state = self._sessions.get(ticket.session_id)
+            return state is not None and state["generation"] == ticket.generation
+
+    def wait(self, ticket, debounce=None):
+        debounce = self.debounce if debounce is None else debounce
+        if debounce > 0:
+            time.sleep(debounce)
+        return self.is_current(ticket)
+
+    async def wait_async(self, ticket, debounce=None):
+        debounce = self.debounce if debounce is None else debounce
+        if debounce > 0:
+            await asyncio.sleep(debounce)
+        return self.is_current(ticket)
+
+    def attach(self, ticket, cancel):
+        with self._lock:
+            ticket.cancels.append(cancel)
+            current = self._sessions[ticket.session_id]["generation"] == ticket.generation
+        if not current:
+            self._cancel(ticket)
+
+    def detach(self, ticket, cancel):
+        # For a prediction the caller cancels itself
+        with self._lock:
+            if cancel in ticket.cancels:
+                ticket.cancels.remove(cancel)
+
+    def finish(self, ticket):
+        with self._lock:
+            state = self._sessions.get(ticket.session_id)
+            if state is None:
+                return
+            if ticket in state["active"]:
+                state["active"].remove(ticket)
+            # Renders can finish out of order, e.g. a newer cached one first
+            if not state["active"]:
+                del self._sessions[ticket.session_id]
+
+    def _cancel(self, ticket):
+        with self._lock:
+            cancels, ticket.cancels = ticket.cancels, []
+            self.cancelled += len(cancels)
+        for cancel in cancels:
+            cancel()
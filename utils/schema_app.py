@@ -0,0 +1,209 @@
+"""Build the Gradio UI from the Cog server's OpenAPI schema.
+
+Resolving the schema with prance is slow, so the resolved inputs and outputs
+and the generated app script are cached on disk under the hash of the raw
+openapi.json. A start with an unchanged schema only downloads the schema and
+rebuilds the components from the cached JSON.
+
+    python -m utils.schema_app --output generated_app.py
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import requests
+
+from utils import cog_client
+
+
+SCHEMA_CACHE_DIR = os.environ.get(
+    "SCHEMA_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "expression-editor", "schema"),
+)
+# Cog describes every file as a uri; pick the component type it gets
+SCHEMA_FILE_TYPE = os.environ.get("SCHEMA_FILE_TYPE", "image")
+FILE_TYPE_EXAMPLES = {"image": "example.png", "audio": "example.wav", "video": "example.mp4"}
+LATEST = "latest"
+
+
+def fetch_schema(base_url):
+    response = cog_client.get(f"{base_url.rstrip('/')}/openapi.json")
+    response.raise_for_status()
+    return response.content
+
+
+def schema_hash(raw_schema):
+    return hashlib.sha256(raw_schema).hexdigest()
+
+
+def resolve_schema(raw_schema):
+    # Only needed on a cache miss, and importing prance is the slow part
+    from prance import ResolvingParser
+
+    parser = ResolvingParser(spec_string=raw_schema.decode("utf-8"), strict=False)
+    schemas = parser.specification["components"]["schemas"]
+    properties = schemas["Input"]["properties"]
+    ordered_inputs = sorted(
+        properties.items(), key=lambda item: item[1].get("x-order", len(properties))
+    )
+    return {
+        "inputs": [[name, prop] for name, prop in ordered_inputs],
+        "output_types": output_types(schemas.get("Output", {})),
+    }
+
+
+def output_types(output_schema, file_type=SCHEMA_FILE_TYPE):
+    if output_schema.get("type") == "array":
+        output_schema = output_schema.get("items", {})
+    if output_schema.get("format") == "uri":
+        return [file_type]
+    if output_schema.get("type") == "string":
+        return ["string"]
+    return ["json"]
+
+
+def example_inputs(resolved, file_type=SCHEMA_FILE_TYPE):
+    # build_gradio_inputs picks the file component from an example's extension
+    example = FILE_TYPE_EXAMPLES.get(file_type)
+    return {
+        name: example
+        for name, prop in resolved["inputs"]
+        if prop.get("format") == "uri" and example
+    }
+
+
+class SchemaCache:
+    def __init__(self, directory=SCHEMA_CACHE_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def path(self, key, filename):
+        return os.path.join(self.directory, key, filename)
+
+    def load(self, key):
+        try:
+            with open(self.path(key, "resolved.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def latest(self):
+        # Lets the UI be built while the Cog server is still starting
+        try:
+            with open(os.path.join(self.directory, LATEST), "r") as f:
+                key = f.read().strip()
+        except OSError:
+            return None, None
+        resolved = self.load(key)
+        return (key, resolved) if resolved is not None else (None, None)
+
+    def store(self, key, raw_schema, resolved):
+        entry_dir = os.path.join(self.directory, key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        with self._lock:
+            os.makedirs(tmp_dir, exist_ok=True)
+            with open(os.path.join(tmp_dir, "openapi.json"), "wb") as f:
+                f.write(raw_schema)
+            with open(os.path.join(tmp_dir, "resolved.json"), "w") as f:
+                json.dump(resolved, f)
+            # Another process may have written the same entry meanwhile
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            self.set_latest(key)
+
+    def set_latest(self, key):
+        tmp_path = os.path.join(self.directory, f"{LATEST}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(key)
+        os.replace(tmp_path, os.path.join(self.directory, LATEST))
+
+    def script_path(self, key, script_kwargs):
+        # One script per set of create_gradio_app_script options
+        options = json.dumps(script_kwargs, sort_keys=True, default=str)
+        digest = hashlib.sha256(options.encode("utf-8")).hexdigest()[:16]
+        return self.path(key, f"app-{digest}.py")
+
+
+def build_components(resolved):
+    from utils.gradio_helpers import build_gradio_inputs, build_gradio_outputs_replicate
+
+    inputs, inputs_string, names = build_gradio_inputs(
+        [tuple(item) for item in resolved["inputs"]], example_inputs(resolved)
+    )
+    outputs, outputs_string = build_gradio_outputs_replicate(resolved["output_types"])
+    return inputs, inputs_string, names, outputs, outputs_string
+
+
+def load_schema_app(base_url=cog_client.COG_API_URL, cache=None, **script_kwargs):
+    # Returns (inputs, outputs, names, script path); script_kwargs go to
+    # create_gradio_app_script
+    from utils.gradio_helpers import create_gradio_app_script
+
+    cache = cache or SchemaCache()
+    try:
+        raw_schema = fetch_schema(base_url)
+    except requests.exceptions.RequestException:
+        key, resolved = cache.latest()
+        if resolved is None:
+            raise
+    else:
+        key = schema_hash(raw_schema)
+        resolved = cache.load(key)
+        if resolved is None:
+            resolved = resolve_schema(raw_schema)
+            cache.store(key, raw_schema, resolved)
+        else:
+            cache.set_latest(key)
+
+    inputs, inputs_string, names, outputs, outputs_string = build_components(resolved)
+    script_kwargs.setdefault("local_base", True)
+    script_path = cache.script_path(key, script_kwargs)
+    if not os.path.exists(script_path):
+        script = create_gradio_app_script(
+            inputs_string,
+            outputs_string,
+            f"{base_url.rstrip('/')}/predictions",
+            **script_kwargs,
+        )
+        tmp_path = f"{script_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(script)
+        os.replace(tmp_path, script_path)
+    return inputs, outputs, names, script_path
+
+
+def create_schema_demo(base_url=cog_client.COG_API_URL, title=""):
+    # Serves the schema-driven UI in-process instead of writing a script
+    from utils.gradio_helpers import create_dynamic_gradio_app
+
+    inputs, outputs, names, _ = load_schema_app(base_url, title=title)
+    return create_dynamic_gradio_app(
+        inputs,
+        outputs,
+        f"{base_url.rstrip('/')}/predictions",
+        title=title,
+        names=names,
+        local_base=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the app from Cog's schema")
+    parser.add_argument("--cog-url", default=cog_client.COG_API_URL)
+    parser.add_argument("--output", help="copy the generated script here")
+    parser.add_argument("--title", default="")
+    args = parser.parse_args()
+    _, _, names, script_path = load_schema_app(args.cog_url, title=args.title)
+    if args.output:
+        shutil.copyfile(script_path, args.output)
+        script_path = args.output
+    print(f"Generated an app with inputs {names} at {script_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+# Handed to followers when the leader gave up for its own reasons, such as
+# being superseded by a newer edit, so one of them runs the call instead
+_retry = object()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, abandoned=None):
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+                    self.leaders += 1
+                else:
+                    self.coalesced += 1
+            if leader:
+                return self._lead(key, future, fn, abandoned)
+            result = future.result()
+            if result is not _retry:
+                return result
+
+    async def do_async(self, key, fn, abandoned=None):
+        # fn is a coroutine function; sync and async callers share flights
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+                    self.leaders += 1
+                else:
+                    self.coalesced += 1
+            if leader:
+                return await self._lead_async(key, future, fn, abandoned)
+            # Shielded so a cancelled follower doesn't cancel the flight
+            result = await asyncio.shield(asyncio.wrap_future(future))
+            if result is not _retry:
+                return result
+
+    def _lead(self, key, future, fn, abandoned):
+        try:
+            result = fn()
+        except BaseException as e:
+            if abandoned is not None and abandoned():
+                future.set_result(_retry)
+            else:
+                future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def _lead_async(self, key, future, fn, abandoned):
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.set_result(_retry)
+            raise
+        except BaseException as e:
+            if abandoned is not None and abandoned():
+                future.set_result(_retry)
+            else:
+                future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "inflight": len(self._calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+            }
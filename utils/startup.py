@@ -0,0 +1,103 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+from utils import cog_client
+
+
+COG_STARTUP_TIMEOUT = float(os.environ.get("COG_STARTUP_TIMEOUT", 1250))
+# How long a request made while warming up waits before giving up
+STARTUP_WAIT = float(os.environ.get("STARTUP_WAIT", 60))
+HEALTH_INTERVAL_MIN = 0.1
+HEALTH_INTERVAL_MAX = 2.0
+
+
+class StartupState:
+    def __init__(self):
+        # Ready unless a supervisor says otherwise, so running app.py after
+        # run.sh-style readiness checks keeps working
+        self.status = "ready"
+        self.detail = ""
+        self._ready = threading.Event()
+        self._ready.set()
+
+    def set(self, status, detail=""):
+        self.status = status
+        self.detail = detail
+        if status == "ready":
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout=STARTUP_WAIT):
+        return self._ready.wait(timeout)
+
+    async def wait_ready_async(self, timeout=STARTUP_WAIT):
+        deadline_at = time.monotonic() + timeout
+        while not self.is_ready():
+            if time.monotonic() >= deadline_at:
+                return False
+            await asyncio.sleep(HEALTH_INTERVAL_MIN)
+        return True
+
+    def describe(self):
+        if self.status == "starting":
+            return "The model server is starting up, the first render will wait for it."
+        if self.status == "warming":
+            return "The model is warming up, the first render will wait for it."
+        if self.status == "failed":
+            return f"The model server failed to start. {self.detail}"
+        return ""
+
+
+startup_state = StartupState()
+
+
+def wait_for_health(base_url, deadline_at, process=None, ready_statuses=("READY",)):
+    interval = HEALTH_INTERVAL_MIN
+    while time.monotonic() < deadline_at:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Cog server exited with code {process.returncode}")
+        try:
+            response = requests.get(f"{base_url}/health-check", timeout=2)
+            if response.json().get("status") in ready_statuses:
+                return
+            if response.json().get("status") == "SETUP_FAILED":
+                raise RuntimeError("Cog setup failed")
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        time.sleep(interval)
+        interval = min(interval * 1.5, HEALTH_INTERVAL_MAX)
+    raise RuntimeError(f"Cog server at {base_url} did not become ready")
+
+
+def make_warm_up_image():
+    from PIL import Image, ImageDraw
+
+    # A rough face so the detector and the expression pipeline both run
+    image = Image.new("RGB", (512, 512), (225, 190, 165))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((136, 96, 376, 416), fill=(235, 200, 175))
+    draw.ellipse((190, 210, 230, 235), fill=(60, 40, 30))
+    draw.ellipse((282, 210, 322, 235), fill=(60, 40, 30))
+    draw.rectangle((246, 250, 266, 310), fill=(215, 170, 145))
+    draw.arc((206, 310, 306, 360), 20, 160, fill=(150, 60, 60), width=6)
+    path = os.path.join(tempfile.mkdtemp(), "warm-up.png")
+    image.save(path)
+    return path
+
+
+def warm_up(base_url, payload):
+    # The model's response doesn't matter, only that CUDA kernels and JIT
+    # caches are initialised before the first user arrives
+    try:
+        cog_client.run_prediction(f"{base_url}/predictions", payload, deadline=300)
+    except (cog_client.PredictionError, requests.exceptions.RequestException) as e:
+        print(f"Warm-up prediction on {base_url} did not succeed: {e}")
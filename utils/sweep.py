@@ -0,0 +1,54 @@
+import itertools
+import os
+
+from PIL import Image, ImageDraw
+
+from utils.output_store import get_output_store
+
+
+SWEEP_MAX_RENDERS = int(os.environ.get("SWEEP_MAX_RENDERS", 64))
+CONTACT_SHEET_CELL = 256
+CONTACT_SHEET_LABEL = 20
+
+
+def sweep_values(minimum, maximum, steps):
+    steps = max(int(steps), 1)
+    if steps == 1:
+        return [round(float(minimum), 4)]
+    span = float(maximum) - float(minimum)
+    return [round(float(minimum) + span * i / (steps - 1), 4) for i in range(steps)]
+
+
+def sweep_grid(axes):
+    # axes is [(name, values), ...]; yields (row, column, {name: value})
+    # with the first axis along the columns and the second down the rows
+    if len(axes) == 1:
+        name, values = axes[0]
+        for column, value in enumerate(values):
+            yield 0, column, {name: value}
+        return
+    (name_x, values_x), (name_y, values_y) = axes
+    for (row, y), (column, x) in itertools.product(
+        enumerate(values_y), enumerate(values_x)
+    ):
+        yield row, column, {name_x: x, name_y: y}
+
+
+def make_contact_sheet(cells, rows, columns):
+    # cells maps (row, column) to (image path, label)
+    cell = CONTACT_SHEET_CELL
+    height = cell + CONTACT_SHEET_LABEL
+    sheet = Image.new("RGB", (columns * cell, rows * height), "white")
+    draw = ImageDraw.Draw(sheet)
+    for (row, column), (path, label) in cells.items():
+        with Image.open(path) as image:
+            image.thumbnail((cell, cell))
+            left = column * cell + (cell - image.width) // 2
+            top = row * height + (cell - image.height) // 2
+            sheet.paste(image.convert("RGB"), (left, top))
+        draw.text((column * cell + 4, row * height + cell + 2), label, fill="black")
+    output_store = get_output_store()
+    filename = output_store.new_path(".webp")
+    sheet.save(filename, quality=90)
+    output_store.add(filename)
+    return filename